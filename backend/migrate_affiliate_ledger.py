@@ -0,0 +1,31 @@
+"""
+Continental Academy - affiliate ledger migration
+Brings affiliate balances that predate the ledger into affiliate_ledger.
+
+Completes ledger entries written before they carried postings and posts an
+opening_balance entry for each affiliate whose balance is not yet covered by
+the ledger, plus an opening_payout entry for each payout still pending from
+before it. Run once after upgrading, ideally while no payouts are processed;
+it is safe to re-run:
+    python migrate_affiliate_ledger.py
+"""
+import asyncio
+
+import server
+
+
+async def main():
+    try:
+        result = await server.open_affiliate_ledger()
+        print(f"Ledger entries upgraded: {result['entries_upgraded']}")
+        print(f"Opening balances posted: {result['opening_balances']}")
+        print(f"Opening payouts posted: {result['opening_payouts']}")
+        report = await server.affiliate_ledger_verifier.run()
+        print(f"Affiliates checked: {report['affiliates_checked']}, drift: {report['drift_count']}")
+        print(f"Pending payouts: {report['pending_payouts']['payouts']}, ledger: {report['pending_payouts']['ledger']}")
+    finally:
+        server.client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""
+Continental Academy - timestamp migration
+Converts ISO-8601 string timestamps written by older releases into native BSON dates.
+
+Conversion runs server side, one update per collection and field, and only touches
+documents where the field is still a string, so it is safe to re-run at any time:
+    python migrate_timestamps.py            # convert
+    python migrate_timestamps.py --dry-run  # only count string timestamps
+Strings MongoDB cannot parse are left unchanged and reported.
+The backend also runs the conversion in the background on every startup.
+"""
+import argparse
+import asyncio
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+load_dotenv(Path(__file__).parent / '.env')
+
+TIMESTAMP_FIELDS = [
+    "created_at",
+    "updated_at",
+    "purchased_at",
+    "paid_at",
+    "activated_at",
+    "cancelled_at",
+    "payment_failed_at",
+    "completed_at",
+    "rejected_at",
+    "reconciled_at",
+]
+
+
+async def migrate(db, dry_run: bool = False, report=print):
+    for collection_name in sorted(await db.list_collection_names()):
+        collection = db[collection_name]
+        for field in TIMESTAMP_FIELDS:
+            as_string = {field: {"$type": "string"}}
+            pending = await collection.count_documents(as_string)
+            if not pending:
+                continue
+            if dry_run:
+                report(f"{collection_name}.{field}: {pending} string timestamps")
+                continue
+
+            result = await collection.update_many(as_string, [
+                {"$set": {field: {"$dateFromString": {"dateString": f"${field}", "onError": f"${field}"}}}}
+            ])
+            unparsed = await collection.count_documents(as_string)
+            report(f"{collection_name}.{field}: converted {pending - unparsed} of {pending}"
+                   f" (matched {result.matched_count})")
+            if unparsed:
+                report(f"  {unparsed} values could not be parsed and were left as strings")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Convert ISO string timestamps to BSON dates")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be converted")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    try:
+        await migrate(client[os.environ['DB_NAME']], dry_run=args.dry_run)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,42 +1,176 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Header
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Header, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from bson import json_util
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
+import re
+import asyncio
 import logging
 import httpx
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Awaitable
+from collections import OrderedDict
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import base64
+import functools
+import gzip
+import hashlib
+import hmac
+import json
+import multiprocessing
 import uuid
-from datetime import datetime, timezone, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from datetime import date, datetime, timezone, timedelta
 import bcrypt
 import jwt
 import stripe
+try:
+    import brotli
+except ImportError:  # optional - catalog responses fall back to gzip
+    brotli = None
+
+from migrate_timestamps import migrate as migrate_timestamps
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware: stored dates come back as UTC-aware datetimes and serialize with an offset
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+def utcnow() -> datetime:
+    """Current UTC time; timestamps are stored as native BSON dates"""
+    return datetime.now(timezone.utc)
+
 # JWT Config
 JWT_SECRET = os.environ.get('JWT_SECRET', 'continental-academy-secret-key-2024')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24
 
+# Password hashing Config
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 1)))
+
+# Catalog cache Config
+CATALOG_CACHE_TTL_SECONDS = float(os.environ.get('CATALOG_CACHE_TTL_SECONDS', '600'))
+CATALOG_CACHE_MAX_ENTRIES = int(os.environ.get('CATALOG_CACHE_MAX_ENTRIES', '256'))
+CATALOG_POLL_SECONDS = float(os.environ.get('CATALOG_POLL_SECONDS', '5'))
+
+# User cache Config
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '30'))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '10000'))
+
 # reCAPTCHA Config
 RECAPTCHA_SECRET_KEY = os.environ.get('RECAPTCHA_SECRET_KEY', '')
+RECAPTCHA_VERIFY_URL = os.environ.get('RECAPTCHA_VERIFY_URL', 'https://www.google.com/recaptcha/api/siteverify')
+RECAPTCHA_TIMEOUT_SECONDS = float(os.environ.get('RECAPTCHA_TIMEOUT_SECONDS', '5'))
+RECAPTCHA_MAX_CONCURRENCY = int(os.environ.get('RECAPTCHA_MAX_CONCURRENCY', '20'))
+RECAPTCHA_BREAKER_THRESHOLD = int(os.environ.get('RECAPTCHA_BREAKER_THRESHOLD', '5'))
+RECAPTCHA_BREAKER_RESET_SECONDS = float(os.environ.get('RECAPTCHA_BREAKER_RESET_SECONDS', '30'))
 
 # Stripe Config
 STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY', 'sk_test_emergent')
 stripe.api_key = STRIPE_API_KEY
+STRIPE_MAX_CONCURRENCY = int(os.environ.get('STRIPE_MAX_CONCURRENCY', '8'))
+STRIPE_TIMEOUT_SECONDS = float(os.environ.get('STRIPE_TIMEOUT_SECONDS', '15'))
+STRIPE_MAX_NETWORK_RETRIES = int(os.environ.get('STRIPE_MAX_NETWORK_RETRIES', '0'))
+# The SDK's own HTTP timeout (80 s by default) bounds how long a pool thread
+# stays busy after the caller gave up; keep it at the gateway deadline
+stripe.default_http_client = stripe.RequestsClient(timeout=STRIPE_TIMEOUT_SECONDS)
+stripe.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+CHECKOUT_STATUS_TTL_SECONDS = float(os.environ.get('CHECKOUT_STATUS_TTL_SECONDS', '5'))
+PAYMENT_WAIT_MAX_SECONDS = float(os.environ.get('PAYMENT_WAIT_MAX_SECONDS', '30'))
+PAYMENT_WAIT_CHECK_SECONDS = float(os.environ.get('PAYMENT_WAIT_CHECK_SECONDS', '3'))
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', '')
+STRIPE_WEBHOOK_TOLERANCE_SECONDS = int(os.environ.get('STRIPE_WEBHOOK_TOLERANCE_SECONDS', '300'))
+STRIPE_EVENT_WORKERS = int(os.environ.get('STRIPE_EVENT_WORKERS', '4'))
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.environ.get('STRIPE_EVENT_MAX_ATTEMPTS', '8'))
+STRIPE_EVENT_POLL_SECONDS = float(os.environ.get('STRIPE_EVENT_POLL_SECONDS', '5'))
+STRIPE_EVENT_LEASE_SECONDS = float(os.environ.get('STRIPE_EVENT_LEASE_SECONDS', '300'))
+STRIPE_EVENT_RETRY_BASE_SECONDS = float(os.environ.get('STRIPE_EVENT_RETRY_BASE_SECONDS', '10'))
+STRIPE_EVENT_RETRY_MAX_SECONDS = float(os.environ.get('STRIPE_EVENT_RETRY_MAX_SECONDS', '3600'))
 
 # ============= STRIPE HELPERS =============
 
+class StripeGateway:
+    """Runs the blocking Stripe SDK on a bounded thread pool.
+
+    Every Stripe call goes through `call`, so a slow Stripe response only ties
+    up one pool thread instead of the event loop. The semaphore is held until
+    the SDK call actually returns, even when the caller timed out, so the
+    number of outstanding Stripe requests never exceeds the pool size. The
+    deadline covers waiting for a slot too: when Stripe is slow and the pool
+    is full, callers fail fast instead of queueing behind it.
+    """
+
+    def __init__(self, max_concurrency: int, timeout: float):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="stripe")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def _release(self, _future):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    async def call(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logging.error(f"Stripe call {getattr(fn, '__qualname__', fn)} found no free slot within {timeout}s")
+            raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        self.calls += 1
+        future = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logging.error(f"Stripe call {getattr(fn, '__qualname__', fn)} timed out after {timeout}s")
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+            "errors": self.errors
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+stripe_gateway = StripeGateway(STRIPE_MAX_CONCURRENCY, STRIPE_TIMEOUT_SECONDS)
+
 async def create_or_update_stripe_price(course_id: str, title: str, price: float):
     """Create or update Stripe product and recurring price for a course"""
     try:
@@ -45,7 +179,8 @@ async def create_or_update_stripe_price(course_id: str, title: str, price: float
         
         if course and course.get('stripe_product_id'):
             # Update existing product
-            product = stripe.Product.modify(
+            product = await stripe_gateway.call(
+                stripe.Product.modify,
                 course['stripe_product_id'],
                 name=f"Continental Academy - {title}",
                 description=f"Mjesečna pretplata za kurs: {title}"
@@ -53,7 +188,8 @@ async def create_or_update_stripe_price(course_id: str, title: str, price: float
             
             # If price changed, create new price (can't update Stripe prices)
             if course.get('price') != price or not course.get('stripe_price_id'):
-                new_price = stripe.Price.create(
+                new_price = await stripe_gateway.call(
+                    stripe.Price.create,
                     product=product.id,
                     unit_amount=int(price * 100),
                     currency='eur',
@@ -63,14 +199,16 @@ async def create_or_update_stripe_price(course_id: str, title: str, price: float
             return product.id, course.get('stripe_price_id')
         else:
             # Create new product
-            product = stripe.Product.create(
+            product = await stripe_gateway.call(
+                stripe.Product.create,
                 name=f"Continental Academy - {title}",
                 description=f"Mjesečna pretplata za kurs: {title}",
                 metadata={'course_id': course_id}
             )
             
             # Create recurring price
-            price_obj = stripe.Price.create(
+            price_obj = await stripe_gateway.call(
+                stripe.Price.create,
                 product=product.id,
                 unit_amount=int(price * 100),
                 currency='eur',
@@ -111,7 +249,7 @@ class UserResponse(BaseModel):
     total_referrals: Optional[int] = 0
     payout_method: Optional[str] = None
     payout_details: Optional[str] = None
-    created_at: str
+    created_at: datetime
 
 class LessonCreate(BaseModel):
     title: str
@@ -162,7 +300,7 @@ class CourseResponse(BaseModel):
     included_courses: List[str] = []
     stripe_price_id: Optional[str] = None
     stripe_product_id: Optional[str] = None
-    created_at: str
+    created_at: datetime
 
 class CancelSubscriptionRequest(BaseModel):
     user_email: str
@@ -256,7 +394,7 @@ class ShopProductResponse(BaseModel):
     features: List[str]
     in_stock: bool
     order: int
-    created_at: str
+    created_at: datetime
 
 class PaymentCreate(BaseModel):
     plan_id: str
@@ -282,12 +420,95 @@ class ContactMessage(BaseModel):
 
 # ============= AUTH HELPERS =============
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+def _bcrypt_hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
 
-def verify_password(password: str, hashed: str) -> bool:
+def _bcrypt_verify(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+class PasswordHasher:
+    """Runs bcrypt on a process pool so hashing never blocks the event loop.
+
+    The pool is created lazily on first use, inside the serving process, and
+    rebuilt if a worker process dies. Workers are started by a forkserver:
+    by then motor and the Stripe pool run threads, and forking a threaded
+    process can leave the child stuck on a lock one of them held.
+    """
+
+    def __init__(self, rounds: int, workers: int):
+        self.rounds = rounds
+        self.workers = max(1, workers)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.queue_depth = 0
+        self.peak_queue_depth = 0
+        self.hashes = 0
+        self.verifications = 0
+        self.rehashes = 0
+        self.total_seconds = 0.0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver")
+            )
+        return self._executor
+
+    async def _run(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        self.queue_depth += 1
+        self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+        started = loop.time()
+        try:
+            try:
+                return await loop.run_in_executor(self._pool(), fn, *args)
+            except BrokenProcessPool:
+                logging.error("Password hashing pool broke, recreating it")
+                self._executor = None
+                return await loop.run_in_executor(self._pool(), fn, *args)
+        finally:
+            self.queue_depth -= 1
+            self.total_seconds += loop.time() - started
+
+    async def hash(self, password: str) -> str:
+        self.hashes += 1
+        return await self._run(_bcrypt_hash, password, self.rounds)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        self.verifications += 1
+        return await self._run(_bcrypt_verify, password, hashed)
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """True when the hash was made with a different cost factor than configured"""
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self) -> dict:
+        operations = self.hashes + self.verifications
+        return {
+            "workers": self.workers,
+            "rounds": self.rounds,
+            "queue_depth": self.queue_depth,
+            "peak_queue_depth": self.peak_queue_depth,
+            "hashes": self.hashes,
+            "verifications": self.verifications,
+            "rehashes": self.rehashes,
+            "avg_ms": round(self.total_seconds * 1000 / operations, 2) if operations else 0.0
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+password_hasher = PasswordHasher(BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS)
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.hash(password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await password_hasher.verify(password, hashed)
+
 def create_token(user_id: str, role: str) -> str:
     payload = {
         'user_id': user_id,
@@ -308,7 +529,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     if not credentials:
         raise HTTPException(status_code=401, detail="Niste prijavljeni")
     payload = decode_token(credentials.credentials)
-    user = await db.users.find_one({"id": payload['user_id']}, {"_id": 0})
+    user = await load_user(payload['user_id'])
     if not user:
         raise HTTPException(status_code=401, detail="Korisnik nije pronađen")
     return user
@@ -323,44 +544,203 @@ async def get_optional_user(credentials: HTTPAuthorizationCredentials = Depends(
         return None
     try:
         payload = decode_token(credentials.credentials)
-        user = await db.users.find_one({"id": payload['user_id']}, {"_id": 0})
-        return user
+        return await load_user(payload['user_id'])
     except:
         return None
 
+# ============= RECAPTCHA =============
+
+class RecaptchaUnavailable(Exception):
+    """The verification service could not be asked (breaker open, timeout, bad response)"""
+
+class RecaptchaVerifier:
+    """Verifies reCAPTCHA tokens against siteverify over one pooled HTTP client.
+
+    The client is opened at startup and closed at shutdown, so registrations
+    reuse warm keep-alive connections instead of paying a TLS handshake each.
+    At most `max_concurrency` verifications run at once. After
+    `failure_threshold` consecutive failures the circuit opens and calls fail
+    fast for `reset_seconds`; then a single trial call decides whether it
+    closes again. `verify_url` can point at a local stub for testing.
+    """
+
+    def __init__(self, secret: str, verify_url: str, timeout: float, max_concurrency: int,
+                 failure_threshold: int, reset_seconds: float):
+        self.secret = secret
+        self.verify_url = verify_url
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        self.verifications = 0
+        self.rejections = 0
+        self.failures = 0
+        self.short_circuits = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.secret)
+
+    def start(self):
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 2.0)),
+            limits=httpx.Limits(
+                max_connections=self.max_concurrency,
+                max_keepalive_connections=self.max_concurrency,
+                keepalive_expiry=60
+            )
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _allow_call(self) -> bool:
+        if self._opened_at is None:
+            return True
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            # Half-open: this call is the trial, the others keep failing fast until it returns
+            self._opened_at = time.monotonic()
+            return True
+        return False
+
+    def _record_failure(self):
+        self.failures += 1
+        self._consecutive_failures += 1
+        if self._opened_at is not None or self._consecutive_failures >= self.failure_threshold:
+            if self._opened_at is None:
+                logging.warning(f"reCAPTCHA circuit opened after {self._consecutive_failures} failures")
+            self._opened_at = time.monotonic()
+
+    async def verify(self, token: Optional[str]) -> bool:
+        """True if Google accepts the token. Raises RecaptchaUnavailable if it could not be checked."""
+        if not self._allow_call():
+            self.short_circuits += 1
+            raise RecaptchaUnavailable("circuit open")
+        if self._client is None:
+            self.start()
+        
+        async with self._semaphore:
+            try:
+                response = await self._client.post(
+                    self.verify_url,
+                    data={'secret': self.secret, 'response': token or ''}
+                )
+                response.raise_for_status()
+                result = response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                self._record_failure()
+                raise RecaptchaUnavailable(str(e)) from e
+        
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self.verifications += 1
+        if not result.get('success'):
+            self.rejections += 1
+            return False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "circuit_open": self._opened_at is not None,
+            "verifications": self.verifications,
+            "rejections": self.rejections,
+            "failures": self.failures,
+            "short_circuits": self.short_circuits
+        }
+
+recaptcha_verifier = RecaptchaVerifier(
+    RECAPTCHA_SECRET_KEY, RECAPTCHA_VERIFY_URL, RECAPTCHA_TIMEOUT_SECONDS, RECAPTCHA_MAX_CONCURRENCY,
+    RECAPTCHA_BREAKER_THRESHOLD, RECAPTCHA_BREAKER_RESET_SECONDS
+)
+
 # ============= AUTH ROUTES =============
 
 def generate_affiliate_code():
-    """Generate unique 8-character affiliate code"""
+    """Generate random 8-character affiliate code"""
     import random
     import string
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
 
+# 36^8 codes: a collision is rare, several in a row means something else is wrong
+AFFILIATE_CODE_ATTEMPTS = 5
+
+def duplicate_key_field(error: DuplicateKeyError) -> Optional[str]:
+    """First field of the unique index that rejected a write"""
+    key_pattern = (error.details or {}).get('keyPattern') or {}
+    return next(iter(key_pattern), None)
+
+async def insert_user_with_affiliate_code(user: dict):
+    """Insert a new user with a fresh affiliate code.
+
+    The unique index on affiliate_code decides whether a code is free: a
+    collision fails the insert and another code is drawn, so no lookup is
+    needed beforehand. Duplicate key errors on other fields are re-raised.
+    """
+    for _ in range(AFFILIATE_CODE_ATTEMPTS):
+        user['affiliate_code'] = generate_affiliate_code()
+        try:
+            await db.users.insert_one(user)
+            return
+        except DuplicateKeyError as e:
+            if duplicate_key_field(e) != 'affiliate_code':
+                raise
+            # insert_one set _id on the document; let the retry get a new one
+            user.pop('_id', None)
+    raise HTTPException(status_code=500, detail="Greška pri generisanju affiliate koda")
+
+async def assign_affiliate_code(user_id: str) -> Optional[str]:
+    """Give an existing user without one an affiliate code and return the user's code.
+
+    Missing affiliate counters are initialised in the same update. If a
+    concurrent request assigned a code first, that code is returned.
+    """
+    for _ in range(AFFILIATE_CODE_ATTEMPTS):
+        affiliate_code = generate_affiliate_code()
+        try:
+            updated = await db.users.find_one_and_update(
+                {"id": user_id, "affiliate_code": {"$not": {"$type": "string"}}},
+                with_token_bump([{"$set": {
+                    "affiliate_code": affiliate_code,
+                    "affiliate_balance": {"$ifNull": ["$affiliate_balance", 0.0]},
+                    "total_earned": {"$ifNull": ["$total_earned", 0.0]},
+                    "total_referrals": {"$ifNull": ["$total_referrals", 0]}
+                }}]),
+                projection={"_id": 0, "affiliate_code": 1}
+            )
+        except DuplicateKeyError as e:
+            if duplicate_key_field(e) != 'affiliate_code':
+                raise
+            continue
+        evict_user(user_id)
+        if updated is None:
+            existing = await db.users.find_one({"id": user_id}, {"_id": 0, "affiliate_code": 1})
+            return existing.get('affiliate_code') if existing else None
+        return affiliate_code
+    raise HTTPException(status_code=500, detail="Greška pri generisanju affiliate koda")
+
 @api_router.post("/auth/register")
 async def register(data: UserCreate, request: Request):
     # Verify reCAPTCHA
-    if RECAPTCHA_SECRET_KEY:
-        async with httpx.AsyncClient() as client:
-            recaptcha_response = await client.post(
-                'https://www.google.com/recaptcha/api/siteverify',
-                data={
-                    'secret': RECAPTCHA_SECRET_KEY,
-                    'response': data.captcha_token
-                }
-            )
-            result = recaptcha_response.json()
-            if not result.get('success'):
-                raise HTTPException(status_code=400, detail="CAPTCHA verifikacija nije uspjela. Molimo pokušajte ponovo.")
+    if recaptcha_verifier.enabled:
+        try:
+            verified = await recaptcha_verifier.verify(data.captcha_token)
+        except RecaptchaUnavailable as e:
+            logging.error(f"reCAPTCHA verification unavailable: {e}")
+            raise HTTPException(status_code=503, detail="CAPTCHA verifikacija trenutno nije dostupna. Molimo pokušajte kasnije.")
+        if not verified:
+            raise HTTPException(status_code=400, detail="CAPTCHA verifikacija nije uspjela. Molimo pokušajte ponovo.")
     
     existing = await db.users.find_one({"email": data.email})
     if existing:
         raise HTTPException(status_code=400, detail="Email već postoji")
     
-    # Generate unique affiliate code
-    affiliate_code = generate_affiliate_code()
-    while await db.users.find_one({"affiliate_code": affiliate_code}):
-        affiliate_code = generate_affiliate_code()
-    
     # Check for referrer from cookie (will be set by frontend)
     referred_by = None
     
@@ -368,19 +748,24 @@ async def register(data: UserCreate, request: Request):
     user = {
         "id": user_id,
         "email": data.email,
-        "password": hash_password(data.password),
+        "password": await hash_password(data.password),
         "name": data.name,
         "role": "user",
         "subscription_status": "inactive",
-        "affiliate_code": affiliate_code,
         "affiliate_balance": 0.0,
         "total_earned": 0.0,
         "total_referrals": 0,
         "referred_by": referred_by,
         "stripe_connect_id": None,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utcnow()
     }
-    await db.users.insert_one(user)
+    try:
+        await insert_user_with_affiliate_code(user)
+    except DuplicateKeyError:
+        # Registered concurrently with the same email
+        raise HTTPException(status_code=400, detail="Email već postoji")
+    await bump_admin_counters(total_users=1)
+    await record_rollup(signups=1)
     
     token = create_token(user_id, "user")
     return {
@@ -391,7 +776,7 @@ async def register(data: UserCreate, request: Request):
             "name": data.name,
             "role": "user",
             "subscription_status": "inactive",
-            "affiliate_code": affiliate_code,
+            "affiliate_code": user['affiliate_code'],
             "affiliate_balance": 0.0,
             "total_earned": 0.0,
             "total_referrals": 0
@@ -401,9 +786,18 @@ async def register(data: UserCreate, request: Request):
 @api_router.post("/auth/login")
 async def login(data: UserLogin):
     user = await db.users.find_one({"email": data.email}, {"_id": 0})
-    if not user or not verify_password(data.password, user['password']):
+    if not user or not await verify_password(data.password, user['password']):
         raise HTTPException(status_code=401, detail="Pogrešan email ili lozinka")
     
+    # Upgrade the stored hash when the configured cost factor changed
+    if password_hasher.needs_rehash(user['password']):
+        await db.users.update_one(
+            {"id": user['id']},
+            with_token_bump({"$set": {"password": await hash_password(data.password)}})
+        )
+        evict_user(user['id'])
+        password_hasher.rehashes += 1
+    
     token = create_token(user['id'], user['role'])
     return {
         "token": token,
@@ -430,12 +824,409 @@ async def get_me(user: dict = Depends(get_current_user)):
         "subscription_status": user['subscription_status']
     }
 
+# ============= CATALOG CACHE =============
+
+class TTLCache:
+    """Small in-process LRU cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: str):
+        """The live value for `key` without counting a lookup or refreshing its LRU position"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key: str, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix: str):
+        for key in [key for key in self._entries if key.startswith(prefix)]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+# Public catalog responses, keyed per endpoint ("courses", "faq", "results", "shop",
+# "settings") plus per-course lesson lists ("lessons:<course_id>")
+catalog_cache = TTLCache(CATALOG_CACHE_TTL_SECONDS, CATALOG_CACHE_MAX_ENTRIES)
+
+# Collections feeding the catalog cache -> (cache keys, cache key prefixes) they invalidate
+CATALOG_COLLECTIONS: Dict[str, tuple] = {
+    "courses": (("courses",), ()),
+    "lessons": ((), ("lessons:",)),
+    "faqs": (("faq",), ()),
+    "results": (("results",), ()),
+    "shop_products": (("shop",), ()),
+    "settings": (("settings",), ()),
+}
+
+# Evictions so far per cache key or prefix from CATALOG_COLLECTIONS, "*" for
+# full clears. A load notes its key's generation before reading MongoDB and
+# drops its result if an eviction happened meanwhile, as it may predate the write.
+catalog_generations: Dict[str, int] = {}
+
+def catalog_generation(key: str) -> int:
+    return sum(
+        count for name, count in catalog_generations.items()
+        if name in ("*", key) or (name.endswith(":") and key.startswith(name))
+    )
+
+def evict_catalog_collection(collection: str):
+    """Drop every cache entry built from the given collection"""
+    keys, prefixes = CATALOG_COLLECTIONS.get(collection, ((), ()))
+    catalog_cache.invalidate(*keys)
+    for prefix in prefixes:
+        catalog_cache.invalidate_prefix(prefix)
+    for name in keys + prefixes:
+        catalog_generations[name] = catalog_generations.get(name, 0) + 1
+
+def clear_catalog_cache():
+    catalog_cache.clear()
+    catalog_generations["*"] = catalog_generations.get("*", 0) + 1
+
+async def notify_catalog_change(collection: str):
+    """Evict locally and bump the collection's version so polling workers evict too"""
+    evict_catalog_collection(collection)
+    await db.catalog_versions.update_one(
+        {"id": collection},
+        {"$inc": {"version": 1}, "$set": {"updated_at": utcnow()}},
+        upsert=True
+    )
+
+class CatalogChangeListener:
+    """Keeps every worker's catalog and user caches in sync with writes made on other workers.
+
+    Watches the catalog collections and users with a change stream. Standalone
+    mongod has no change streams, so it falls back to polling the
+    catalog_versions counters that notify_catalog_change bumps on every write,
+    and the users whose token_changed_at moved since the last poll.
+    """
+
+    # Users changed this long before the newest change seen are polled again,
+    # for writes that commit after a poll read past their timestamp
+    USER_POLL_OVERLAP = timedelta(seconds=30)
+
+    def __init__(self, poll_seconds: float):
+        self.poll_seconds = poll_seconds
+        self.mode = "stopped"
+        self.events = 0
+        self._versions: Dict[str, int] = {}
+        self._users_since: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.mode = "stopped"
+
+    async def _run(self):
+        while True:
+            try:
+                await self._watch()
+            except OperationFailure as e:
+                logging.warning(f"Change streams unavailable ({e}), polling catalog versions instead")
+                await self._poll()
+                return
+            except Exception as e:
+                # Events may have been missed while disconnected
+                logging.error(f"Catalog change stream interrupted: {e}")
+                clear_catalog_cache()
+                user_cache.clear()
+                await asyncio.sleep(self.poll_seconds)
+
+    async def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(CATALOG_COLLECTIONS) + ["users"]}}}]
+        async with db.watch(pipeline, full_document="updateLookup") as stream:
+            self.mode = "change_stream"
+            async for change in stream:
+                self.events += 1
+                if change['ns']['coll'] != "users":
+                    evict_catalog_collection(change['ns']['coll'])
+                elif change.get('fullDocument'):
+                    evict_user(change['fullDocument']['id'])
+                else:
+                    # Deleted; the event only carries the _id
+                    user_cache.clear()
+
+    async def _poll(self):
+        self.mode = "polling"
+        while True:
+            try:
+                watched = list(CATALOG_COLLECTIONS) + [USER_DELETIONS_VERSION]
+                versions = await db.catalog_versions.find(
+                    {"id": {"$in": watched}}, {"_id": 0, "id": 1, "version": 1}
+                ).to_list(None)
+                for doc in versions:
+                    previous = self._versions.get(doc['id'])
+                    if previous is not None and previous != doc['version']:
+                        self.events += 1
+                        if doc['id'] == USER_DELETIONS_VERSION:
+                            user_cache.clear()
+                        else:
+                            evict_catalog_collection(doc['id'])
+                    self._versions[doc['id']] = doc['version']
+                # A version document created after this poll is a change too
+                for name in watched:
+                    self._versions.setdefault(name, 0)
+                await self._poll_users()
+            except Exception as e:
+                logging.error(f"Catalog version poll failed: {e}")
+            await asyncio.sleep(self.poll_seconds)
+
+    async def _poll_users(self):
+        """Evict users whose token_version moved since the last poll"""
+        if self._users_since is None:
+            # Nothing is cached from before the listener started
+            latest = await db.users.find_one(
+                {"token_changed_at": {"$exists": True}}, {"_id": 0, "token_changed_at": 1},
+                sort=[("token_changed_at", DESCENDING)]
+            )
+            self._users_since = latest['token_changed_at'] if latest else utcnow()
+            return
+        changed = await db.users.find(
+            {"token_changed_at": {"$gt": self._users_since - self.USER_POLL_OVERLAP}},
+            {"_id": 0, "id": 1, "token_version": 1, "token_changed_at": 1}
+        ).to_list(None)
+        self.events += evict_stale_users(changed)
+        if changed:
+            self._users_since = max(self._users_since, *(doc['token_changed_at'] for doc in changed))
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "events": self.events}
+
+catalog_listener = CatalogChangeListener(CATALOG_POLL_SECONDS)
+
+# Bodies smaller than this are not worth compressing
+CATALOG_COMPRESS_MIN_BYTES = 512
+# Quality 11 is dozens of times slower than 6 for roughly a tenth smaller output
+CATALOG_BROTLI_QUALITY = 6
+
+class CatalogSnapshot:
+    """A cached catalog response, encoded once and served as raw bytes.
+
+    The payload is validated against its response model, serialized and
+    compressed to gzip/brotli once, when the snapshot is built; catalog_snapshot
+    builds it in a worker thread so the event loop never does. The ETag hashes the encoded body, so
+    every worker derives the same tag for the same content. It is weak because
+    all encodings of the body share it.
+    """
+
+    __slots__ = ("data", "body", "etag", "built_at", "last_modified", "_encoded")
+
+    def __init__(self, data: Any, model: Optional[type] = None):
+        if model is not None:
+            data = [model.model_validate(item).model_dump(mode="json") for item in data]
+        self.data = data
+        self.body = json.dumps(
+            jsonable_encoder(data), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode('utf-8')
+        self.etag = f'W/"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.built_at = int(time.time())
+        self.last_modified = formatdate(self.built_at, usegmt=True)
+        self._encoded: Dict[str, bytes] = {}
+        if len(self.body) >= CATALOG_COMPRESS_MIN_BYTES:
+            if brotli is not None:
+                self._encoded["br"] = brotli.compress(self.body, quality=CATALOG_BROTLI_QUALITY)
+            self._encoded["gzip"] = gzip.compress(self.body, compresslevel=9, mtime=0)
+
+    def not_modified(self, request: Request) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            if if_none_match.strip() == "*":
+                return True
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return self.etag.removeprefix("W/") in tags
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.built_at
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def validator_headers(self) -> Dict[str, str]:
+        return {
+            "ETag": self.etag,
+            "Last-Modified": self.last_modified,
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding"
+        }
+
+    def encoded(self, accept_encoding: str):
+        """Pick the best encoding the client accepts; returns (encoding or None, bytes)"""
+        if not self._encoded:
+            return None, self.body
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding not in self._encoded:
+                continue
+            if accepted.get(encoding, accepted.get("*", 0.0)) <= 0:
+                continue
+            return encoding, self._encoded[encoding]
+        return None, self.body
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into {coding: q-value}"""
+    accepted: Dict[str, float] = {}
+    for part in header.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+async def catalog_snapshot(key: str, loader: Callable[[], Awaitable[Any]], model: Optional[type] = None) -> CatalogSnapshot:
+    """Serve a public catalog read from memory, loading it from MongoDB on a miss"""
+    snapshot = catalog_cache.get(key)
+    if snapshot is None:
+        generation = catalog_generation(key)
+        data = await loader()
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, CatalogSnapshot, data, model)
+        if catalog_generation(key) == generation:
+            catalog_cache.set(key, snapshot)
+    return snapshot
+
+async def cached_catalog(key: str, loader: Callable[[], Awaitable[Any]]):
+    return (await catalog_snapshot(key, loader)).data
+
+async def catalog_response(request: Request, key: str, loader: Callable[[], Awaitable[Any]], model: Optional[type] = None) -> Response:
+    """Return the snapshot's pre-encoded bytes, or a 304 when the client copy is current"""
+    snapshot = await catalog_snapshot(key, loader, model)
+    headers = snapshot.validator_headers()
+    if snapshot.not_modified(request):
+        return Response(status_code=304, headers=headers)
+    encoding, body = snapshot.encoded(request.headers.get("accept-encoding", ""))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# ============= USER CACHE =============
+
+# Authenticated user documents, keyed by user id
+user_cache = TTLCache(USER_CACHE_TTL_SECONDS, USER_CACHE_MAX_ENTRIES)
+# A deleted user leaves no document to poll for; deletions bump this
+# catalog_versions entry instead and workers drop their whole user cache
+USER_DELETIONS_VERSION = "users"
+
+def with_token_bump(update):
+    """Add the token_version bump to an update of a user document.
+
+    Every write to a user document (role, subscription, password, balances,
+    payout details) goes through this, so the version and the time of the
+    change land in the same write. The catalog listener uses them to evict
+    stale copies on every worker. Accepts update documents and pipelines.
+    """
+    if isinstance(update, list):
+        return update + [{"$set": {
+            "token_version": {"$add": [{"$ifNull": ["$token_version", 0]}, 1]},
+            "token_changed_at": "$$NOW"
+        }}]
+    return {
+        **update,
+        "$inc": {**update.get("$inc", {}), "token_version": 1},
+        "$currentDate": {"token_changed_at": True}
+    }
+
+def evict_user(user_id: str):
+    """Drop this worker's copy right after a write; other workers follow on their next poll"""
+    user_cache.invalidate(user_id)
+
+def evict_stale_users(changed: List[dict]) -> int:
+    """Evict cached users older than the given {id, token_version} documents.
+    Also catches a copy a concurrent request stored from a read before the write."""
+    evicted = 0
+    for doc in changed:
+        cached = user_cache.peek(doc['id'])
+        if cached is not None and cached.get('token_version', 0) < doc.get('token_version', 0):
+            user_cache.invalidate(doc['id'])
+            evicted += 1
+    return evicted
+
+async def notify_user_deleted(user_id: str):
+    evict_user(user_id)
+    await db.catalog_versions.update_one(
+        {"id": USER_DELETIONS_VERSION},
+        {"$inc": {"version": 1}, "$set": {"updated_at": utcnow()}},
+        upsert=True
+    )
+
+async def load_user(user_id: str) -> Optional[dict]:
+    """User document for an authenticated request, served from the user cache when fresh"""
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        if user is None:
+            return None
+        user_cache.set(user_id, user)
+    # Handlers may modify the document they get; keep the cached copy intact
+    return dict(user)
+
 # ============= COURSES ROUTES =============
 
 @api_router.get("/courses", response_model=List[CourseResponse])
-async def get_courses():
-    courses = await db.courses.find({}, {"_id": 0}).sort("order", 1).to_list(100)
-    return courses
+async def get_courses(request: Request):
+    return await catalog_response(
+        request, "courses",
+        lambda: db.courses.find({}, {"_id": 0}).sort("order", 1).to_list(100),
+        CourseResponse
+    )
 
 @api_router.get("/courses/{course_id}")
 async def get_course(course_id: str, user: dict = Depends(get_optional_user)):
@@ -468,9 +1259,11 @@ async def create_course(data: CourseCreate, admin: dict = Depends(get_admin_user
         **data.model_dump(),
         "stripe_product_id": stripe_product_id,
         "stripe_price_id": stripe_price_id,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utcnow()
     }
     await db.courses.insert_one(course)
+    await bump_admin_counters(total_courses=1)
+    await notify_catalog_change("courses")
     return CourseResponse(**course)
 
 @api_router.put("/courses/{course_id}")
@@ -504,19 +1297,150 @@ async def update_course(course_id: str, data: CourseUpdate, admin: dict = Depend
     result = await db.courses.update_one({"id": course_id}, {"$set": update_data})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Kurs nije pronađen")
+    await notify_catalog_change("courses")
+    
+    # Bundle contents changed - owners' flattened entitlements are stale
+    bundle_changed = any(
+        key in update_data and update_data[key] != current_course.get(key, default)
+        for key, default in (('included_courses', []), ('course_type', 'single'))
+    )
+    if bundle_changed:
+        await refresh_course_owner_entitlements(course_id)
     
     course = await db.courses.find_one({"id": course_id}, {"_id": 0})
     return course
 
 @api_router.delete("/courses/{course_id}")
 async def delete_course(course_id: str, admin: dict = Depends(get_admin_user)):
-    result = await db.courses.delete_one({"id": course_id})
-    if result.deleted_count == 0:
+    course = await db.courses.find_one_and_delete({"id": course_id}, {"_id": 0})
+    if not course:
         raise HTTPException(status_code=404, detail="Kurs nije pronađen")
+    await bump_admin_counters(total_courses=-1)
+    await notify_catalog_change("courses")
     # Also delete all lessons for this course
     await db.lessons.delete_many({"course_id": course_id})
+    await notify_catalog_change("lessons")
+    # Owners of a deleted bundle lose access to its included courses
+    if course.get('course_type') == 'bundle':
+        await refresh_course_owner_entitlements(course_id)
     return {"message": "Kurs obrisan"}
 
+# ============= ENTITLEMENTS =============
+
+async def fetch_courses_by_ids(course_ids: List[str]) -> Dict[str, dict]:
+    """Load courses for the given IDs in a single query, keyed by course ID"""
+    if not course_ids:
+        return {}
+    courses = await db.courses.find({"id": {"$in": list(course_ids)}}, {"_id": 0}).to_list(None)
+    return {course['id']: course for course in courses}
+
+async def resolve_user_entitlements(user_id: str):
+    """Resolve every course a user can access, expanding bundles.
+
+    Runs two queries: one for user_courses and one aggregation that loads the
+    owned courses together with the courses included in owned bundles.
+    Returns the accessible course IDs (purchase order first, then bundle
+    contents) and the loaded course documents keyed by ID.
+    """
+    user_courses = await db.user_courses.find({"user_id": user_id}, {"_id": 0, "course_id": 1}).to_list(None)
+    owned_ids = list(dict.fromkeys(uc['course_id'] for uc in user_courses))
+    if not owned_ids:
+        return [], {}
+
+    owned_courses = await db.courses.aggregate([
+        {"$match": {"id": {"$in": owned_ids}}},
+        {"$lookup": {
+            "from": "courses",
+            "localField": "included_courses",
+            "foreignField": "id",
+            "as": "_included"
+        }},
+        {"$project": {"_id": 0, "_included._id": 0}}
+    ]).to_list(None)
+
+    courses_by_id: Dict[str, dict] = {}
+    included_ids: List[str] = []
+    for course in owned_courses:
+        included = course.pop('_included', [])
+        courses_by_id[course['id']] = course
+        if course.get('course_type') == 'bundle':
+            included_ids.extend(course.get('included_courses', []))
+            for included_course in included:
+                courses_by_id.setdefault(included_course['id'], included_course)
+
+    accessible_ids = list(dict.fromkeys(owned_ids + included_ids))
+    return accessible_ids, courses_by_id
+
+async def load_user_lesson_groups(user_id: str) -> List[dict]:
+    """Group lessons by course for every course the user can access.
+
+    Runs a fixed three queries regardless of how many courses or bundles the
+    user owns (user_courses, courses with bundle contents, lessons); the
+    grouping is done in memory.
+    """
+    accessible_ids, courses = await resolve_user_entitlements(user_id)
+    course_ids = [course_id for course_id in accessible_ids if course_id in courses]
+    if not course_ids:
+        return []
+
+    lessons = await db.lessons.find(
+        {"course_id": {"$in": course_ids}}, {"_id": 0}
+    ).sort("order", 1).to_list(None)
+
+    lessons_by_course: Dict[str, List[dict]] = {}
+    for lesson in lessons:
+        lessons_by_course.setdefault(lesson['course_id'], []).append(lesson)
+
+    return [
+        {"course": courses[course_id], "lessons": lessons_by_course[course_id]}
+        for course_id in course_ids
+        if lessons_by_course.get(course_id)
+    ]
+
+async def refresh_user_entitlements(user_id: str) -> List[str]:
+    """Recompute and store the flattened course IDs a user can access.
+
+    Each refresh takes a sequence number before it reads user_courses and only
+    stores its result if no later refresh stored one first, so concurrent
+    refreshes (a webhook cancelling while an admin assigns) cannot leave the
+    older computation behind.
+    """
+    ticket = await db.user_entitlements.find_one_and_update(
+        {"user_id": user_id},
+        {"$inc": {"requested_seq": 1}, "$setOnInsert": {"user_id": user_id}},
+        projection={"_id": 0, "requested_seq": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    seq = ticket['requested_seq']
+    accessible_ids, _ = await resolve_user_entitlements(user_id)
+    await db.user_entitlements.update_one(
+        {"user_id": user_id, "computed_seq": {"$not": {"$gte": seq}}},
+        {"$set": {
+            "course_ids": accessible_ids,
+            "computed_seq": seq,
+            "updated_at": utcnow()
+        }}
+    )
+    return accessible_ids
+
+async def refresh_course_owner_entitlements(course_id: str):
+    """Refresh the entitlements of every user who owns the given course (e.g. a bundle)"""
+    owner_ids = await db.user_courses.distinct("user_id", {"course_id": course_id})
+    for user_id in owner_ids:
+        await refresh_user_entitlements(user_id)
+
+async def user_has_course_access(user_id: str, course_id: str) -> bool:
+    """Check course access against the materialized user_entitlements document"""
+    entitlements = await db.user_entitlements.find_one({"user_id": user_id}, {"_id": 0, "course_ids": 1})
+    if entitlements is None or 'course_ids' not in entitlements:
+        # Users who have not bought anything since entitlements were introduced,
+        # or whose first refresh is still running
+        course_ids = await refresh_user_entitlements(user_id)
+    else:
+        course_ids = entitlements.get('course_ids', [])
+    return course_id in course_ids
+
 # ============= LESSONS ROUTES =============
 
 @api_router.get("/courses/{course_id}/lessons")
@@ -534,26 +1458,17 @@ async def get_course_lessons(course_id: str, user: dict = Depends(get_optional_u
             can_access = True
         elif user.get('subscription_status') == 'active':
             can_access = True
-        else:
-            # Check if user purchased this course or a bundle containing it
-            user_courses = await db.user_courses.find({"user_id": user['id']}, {"_id": 0}).to_list(100)
-            user_course_ids = [uc['course_id'] for uc in user_courses]
-            
-            if course_id in user_course_ids:
-                can_access = True
-            else:
-                # Check if user has a bundle that includes this course
-                for uc_id in user_course_ids:
-                    bundle = await db.courses.find_one({"id": uc_id, "course_type": "bundle"}, {"_id": 0})
-                    if bundle and course_id in bundle.get('included_courses', []):
-                        can_access = True
-                        break
+        elif await user_has_course_access(user['id'], course_id):
+            # User purchased this course or a bundle containing it
+            can_access = True
     
     if not can_access:
         raise HTTPException(status_code=403, detail="Nemate pristup ovom kursu")
     
-    lessons = await db.lessons.find({"course_id": course_id}, {"_id": 0}).sort("order", 1).to_list(100)
-    return lessons
+    return await cached_catalog(
+        f"lessons:{course_id}",
+        lambda: db.lessons.find({"course_id": course_id}, {"_id": 0}).sort("order", 1).to_list(100)
+    )
 
 @api_router.post("/courses/{course_id}/lessons")
 async def create_lesson(course_id: str, data: LessonCreate, admin: dict = Depends(get_admin_user)):
@@ -570,6 +1485,7 @@ async def create_lesson(course_id: str, data: LessonCreate, admin: dict = Depend
         **data.model_dump()
     }
     await db.lessons.insert_one(lesson)
+    await notify_catalog_change("lessons")
     return LessonResponse(**lesson)
 
 @api_router.put("/lessons/{lesson_id}")
@@ -578,6 +1494,7 @@ async def update_lesson(lesson_id: str, data: LessonCreate, admin: dict = Depend
     result = await db.lessons.update_one({"id": lesson_id}, {"$set": data.model_dump()})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Lekcija nije pronađena")
+    await notify_catalog_change("lessons")
     lesson = await db.lessons.find_one({"id": lesson_id}, {"_id": 0})
     return lesson
 
@@ -587,38 +1504,13 @@ async def delete_lesson(lesson_id: str, admin: dict = Depends(get_admin_user)):
     result = await db.lessons.delete_one({"id": lesson_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Lekcija nije pronađena")
+    await notify_catalog_change("lessons")
     return {"message": "Lekcija obrisana"}
 
 @api_router.get("/user/lessons")
 async def get_user_lessons(user: dict = Depends(get_current_user)):
     """Get all lessons accessible to the current user based on their purchased courses"""
-    # Get user's purchased courses
-    user_courses = await db.user_courses.find({"user_id": user['id']}, {"_id": 0}).to_list(100)
-    accessible_course_ids = set()
-    
-    for uc in user_courses:
-        course_id = uc['course_id']
-        accessible_course_ids.add(course_id)
-        
-        # Check if it's a bundle and add included courses
-        course = await db.courses.find_one({"id": course_id}, {"_id": 0})
-        if course and course.get('course_type') == 'bundle':
-            for included_id in course.get('included_courses', []):
-                accessible_course_ids.add(included_id)
-    
-    # Get all lessons for accessible courses
-    lessons_with_courses = []
-    for course_id in accessible_course_ids:
-        course = await db.courses.find_one({"id": course_id}, {"_id": 0})
-        if course:
-            lessons = await db.lessons.find({"course_id": course_id}, {"_id": 0}).sort("order", 1).to_list(100)
-            if lessons:
-                lessons_with_courses.append({
-                    "course": course,
-                    "lessons": lessons
-                })
-    
-    return lessons_with_courses
+    return await load_user_lesson_groups(user['id'])
 
 # ============= ADMIN ASSIGN COURSE =============
 
@@ -645,8 +1537,9 @@ async def admin_assign_course(data: AssignCourseRequest, admin: dict = Depends(g
         "user_id": data.user_id,
         "course_id": data.course_id,
         "assigned_by_admin": True,
-        "purchased_at": datetime.now(timezone.utc).isoformat()
+        "purchased_at": utcnow()
     })
+    await refresh_user_entitlements(data.user_id)
     
     return {"message": f"Kurs '{course['title']}' dodijeljen korisniku {user['email']}"}
 
@@ -656,6 +1549,7 @@ async def admin_remove_course(user_id: str, course_id: str, admin: dict = Depend
     result = await db.user_courses.delete_one({"user_id": user_id, "course_id": course_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Kurs nije pronađen za ovog korisnika")
+    await refresh_user_entitlements(user_id)
     return {"message": "Kurs uklonjen od korisnika"}
 
 @api_router.get("/admin/user-courses/{user_id}")
@@ -664,26 +1558,25 @@ async def get_user_assigned_courses(user_id: str, admin: dict = Depends(get_admi
     user_courses = await db.user_courses.find({"user_id": user_id}, {"_id": 0}).to_list(100)
     course_ids = [uc['course_id'] for uc in user_courses]
     
-    courses = []
-    for course_id in course_ids:
-        course = await db.courses.find_one({"id": course_id}, {"_id": 0})
-        if course:
-            courses.append(course)
-    
-    return courses
+    courses_by_id = await fetch_courses_by_ids(course_ids)
+    return [courses_by_id[course_id] for course_id in course_ids if course_id in courses_by_id]
 
 # ============= FAQ ROUTES =============
 
 @api_router.get("/faq", response_model=List[FAQResponse])
-async def get_faqs():
-    faqs = await db.faqs.find({}, {"_id": 0}).sort("order", 1).to_list(100)
-    return faqs
+async def get_faqs(request: Request):
+    return await catalog_response(
+        request, "faq",
+        lambda: db.faqs.find({}, {"_id": 0}).sort("order", 1).to_list(100),
+        FAQResponse
+    )
 
 @api_router.post("/faq", response_model=FAQResponse)
 async def create_faq(data: FAQCreate, admin: dict = Depends(get_admin_user)):
     faq_id = str(uuid.uuid4())
     faq = {"id": faq_id, **data.model_dump()}
     await db.faqs.insert_one(faq)
+    await notify_catalog_change("faqs")
     return FAQResponse(**faq)
 
 @api_router.put("/faq/{faq_id}")
@@ -691,6 +1584,7 @@ async def update_faq(faq_id: str, data: FAQCreate, admin: dict = Depends(get_adm
     result = await db.faqs.update_one({"id": faq_id}, {"$set": data.model_dump()})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="FAQ nije pronađen")
+    await notify_catalog_change("faqs")
     faq = await db.faqs.find_one({"id": faq_id}, {"_id": 0})
     return faq
 
@@ -699,20 +1593,25 @@ async def delete_faq(faq_id: str, admin: dict = Depends(get_admin_user)):
     result = await db.faqs.delete_one({"id": faq_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="FAQ nije pronađen")
+    await notify_catalog_change("faqs")
     return {"message": "FAQ obrisan"}
 
 # ============= RESULTS ROUTES =============
 
 @api_router.get("/results", response_model=List[ResultResponse])
-async def get_results():
-    results = await db.results.find({}, {"_id": 0}).sort("order", 1).to_list(100)
-    return results
+async def get_results(request: Request):
+    return await catalog_response(
+        request, "results",
+        lambda: db.results.find({}, {"_id": 0}).sort("order", 1).to_list(100),
+        ResultResponse
+    )
 
 @api_router.post("/results", response_model=ResultResponse)
 async def create_result(data: ResultCreate, admin: dict = Depends(get_admin_user)):
     result_id = str(uuid.uuid4())
     result = {"id": result_id, **data.model_dump()}
     await db.results.insert_one(result)
+    await notify_catalog_change("results")
     return ResultResponse(**result)
 
 @api_router.put("/results/{result_id}")
@@ -720,6 +1619,7 @@ async def update_result(result_id: str, data: ResultCreate, admin: dict = Depend
     res = await db.results.update_one({"id": result_id}, {"$set": data.model_dump()})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Rezultat nije pronađen")
+    await notify_catalog_change("results")
     result = await db.results.find_one({"id": result_id}, {"_id": 0})
     return result
 
@@ -728,14 +1628,18 @@ async def delete_result(result_id: str, admin: dict = Depends(get_admin_user)):
     result = await db.results.delete_one({"id": result_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Rezultat nije pronađen")
+    await notify_catalog_change("results")
     return {"message": "Rezultat obrisan"}
 
 # ============= SHOP ROUTES =============
 
 @api_router.get("/shop", response_model=List[ShopProductResponse])
-async def get_shop_products():
-    products = await db.shop_products.find({}, {"_id": 0}).sort("order", 1).to_list(100)
-    return products
+async def get_shop_products(request: Request):
+    return await catalog_response(
+        request, "shop",
+        lambda: db.shop_products.find({}, {"_id": 0}).sort("order", 1).to_list(100),
+        ShopProductResponse
+    )
 
 @api_router.get("/shop/{product_id}")
 async def get_shop_product(product_id: str):
@@ -750,9 +1654,10 @@ async def create_shop_product(data: ShopProductCreate, admin: dict = Depends(get
     product = {
         "id": product_id,
         **data.model_dump(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utcnow()
     }
     await db.shop_products.insert_one(product)
+    await notify_catalog_change("shop_products")
     return ShopProductResponse(**product)
 
 @api_router.put("/shop/{product_id}")
@@ -760,6 +1665,7 @@ async def update_shop_product(product_id: str, data: ShopProductCreate, admin: d
     result = await db.shop_products.update_one({"id": product_id}, {"$set": data.model_dump()})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Proizvod nije pronađen")
+    await notify_catalog_change("shop_products")
     product = await db.shop_products.find_one({"id": product_id}, {"_id": 0})
     return product
 
@@ -768,19 +1674,24 @@ async def delete_shop_product(product_id: str, admin: dict = Depends(get_admin_u
     result = await db.shop_products.delete_one({"id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Proizvod nije pronađen")
+    await notify_catalog_change("shop_products")
     return {"message": "Proizvod obrisan"}
 
 # ============= SITE SETTINGS ROUTES =============
 
-@api_router.get("/settings")
-async def get_settings():
+async def load_settings():
     settings = await db.settings.find_one({"id": "main"}, {"_id": 0})
     if not settings:
         default = SiteSettings()
         settings = {"id": "main", **default.model_dump()}
         await db.settings.insert_one(settings)
+        settings.pop('_id', None)
     return settings
 
+@api_router.get("/settings")
+async def get_settings(request: Request):
+    return await catalog_response(request, "settings", load_settings)
+
 @api_router.put("/settings")
 async def update_settings(data: SiteSettings, admin: dict = Depends(get_admin_user)):
     await db.settings.update_one(
@@ -788,6 +1699,7 @@ async def update_settings(data: SiteSettings, admin: dict = Depends(get_admin_us
         {"$set": data.model_dump()}, 
         upsert=True
     )
+    await notify_catalog_change("settings")
     settings = await db.settings.find_one({"id": "main"}, {"_id": 0})
     return settings
 
@@ -811,7 +1723,8 @@ async def create_checkout(data: PaymentCreate, request: Request, user: dict = De
     cancel_url = f"{data.origin_url}/courses"
     
     try:
-        session = stripe.checkout.Session.create(
+        session = await stripe_gateway.call(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=[{
                 'price_data': {
@@ -845,7 +1758,7 @@ async def create_checkout(data: PaymentCreate, request: Request, user: dict = De
         "amount": plan['price'],
         "currency": "eur",
         "payment_status": "pending",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utcnow()
     }
     await db.payment_transactions.insert_one(transaction)
     
@@ -879,6 +1792,7 @@ async def subscribe_to_course(data: CourseSubscription, request: Request, user:
                 {"id": data.course_id},
                 {"$set": {"stripe_product_id": stripe_product_id, "stripe_price_id": stripe_price_id}}
             )
+            await notify_catalog_change("courses")
     
     if not stripe_price_id:
         raise HTTPException(status_code=500, detail="Greška pri kreiranju cijene. Kontaktirajte podršku.")
@@ -888,7 +1802,8 @@ async def subscribe_to_course(data: CourseSubscription, request: Request, user:
     
     try:
         # Create Stripe Checkout Session for SUBSCRIPTION
-        session = stripe.checkout.Session.create(
+        session = await stripe_gateway.call(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=[{
                 'price': stripe_price_id,
@@ -927,7 +1842,7 @@ async def subscribe_to_course(data: CourseSubscription, request: Request, user:
         "amount": course['price'],
         "currency": "eur",
         "status": "pending",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utcnow()
     }
     await db.subscriptions.insert_one(subscription_record)
     
@@ -950,7 +1865,8 @@ async def purchase_shop_product(data: ShopProductPurchase, request: Request, use
     cancel_url = f"{data.origin_url}/shop"
     
     try:
-        session = stripe.checkout.Session.create(
+        session = await stripe_gateway.call(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=[{
                 'price_data': {
@@ -988,80 +1904,277 @@ async def purchase_shop_product(data: ShopProductPurchase, request: Request, use
         "currency": "eur",
         "payment_status": "pending",
         "type": "shop_product",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utcnow()
     }
     await db.payment_transactions.insert_one(transaction)
     
     return {"url": session.url, "session_id": session.id}
 
-@api_router.get("/payments/status/{session_id}")
-async def get_payment_status(session_id: str, request: Request):
+async def claim_fulfilment_step(collection, session_id: str, step: str) -> bool:
+    """Mark a one-off fulfilment step of a checkout record as done.
+
+    True only for the first caller, so counters and analytics are never
+    applied twice. The claim is taken before the step runs: a failure right
+    after it skips that one increment rather than repeating it on retry.
+    """
+    result = await collection.update_one(
+        {"session_id": session_id, f"fulfilment.{step}": {"$exists": False}},
+        {"$set": {f"fulfilment.{step}": utcnow()}}
+    )
+    return result.modified_count == 1
+
+async def activate_course_subscription(session_id: str, stripe_subscription_id: Optional[str]) -> Optional[dict]:
+    """Activate a paid course subscription and fulfil it.
+
+    The webhook and the status endpoint can both see the same completed
+    checkout, and the webhook consumer retries failed attempts, so every step
+    is safe to repeat: access is granted on every call, the commission is
+    idempotent per referral and the analytics increment is claimed once.
+    fulfilled_at is set last; until then a later call finishes what an
+    earlier one left undone. Returns the record, or None if it is not active.
+    """
+    subscription_record = await db.subscriptions.find_one_and_update(
+        {"session_id": session_id, "status": {"$in": ["pending", "active"]}},
+        [{"$set": {
+            "status": "active",
+            "stripe_subscription_id": {"$ifNull": ["$stripe_subscription_id", stripe_subscription_id]},
+            "activated_at": {"$ifNull": ["$activated_at", utcnow()]}
+        }}],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not subscription_record:
+        return None
+    
+    # Grant course access
+    await db.user_courses.update_one(
+        {"user_id": subscription_record['user_id'], "course_id": subscription_record['course_id']},
+        {"$set": {
+            "user_id": subscription_record['user_id'],
+            "course_id": subscription_record['course_id'],
+            "subscription_id": subscription_record['id']
+        }, "$setOnInsert": {"purchased_at": utcnow()}},
+        upsert=True
+    )
+    await refresh_user_entitlements(subscription_record['user_id'])
+    if subscription_record.get('fulfilled_at'):
+        return subscription_record
+    
+    # Credit affiliate commission (only first purchase)
+    await credit_affiliate_commission(
+        subscription_record['user_id'],
+        subscription_record['amount'],
+        subscription_record['course_id']
+    )
+    if await claim_fulfilment_step(db.subscriptions, session_id, "rollup"):
+        await record_rollup(
+            subscriptions_activated=1,
+            subscription_revenue_cents=round(subscription_record.get('amount', 0) * 100)
+        )
+    await db.subscriptions.update_one({"session_id": session_id}, {"$set": {"fulfilled_at": utcnow()}})
+    return subscription_record
+
+async def complete_checkout_session(session_id: str, stripe_subscription_id: Optional[str]):
+    """Apply a paid checkout session to the local records.
+
+    Safe to call any number of times for the same session from the status
+    endpoints and the webhook processor, and completes a fulfilment an earlier
+    call left half done; waiters on the session are woken.
+    """
+    # Check if this is a subscription
+    subscription_record = await db.subscriptions.find_one({"session_id": session_id}, {"_id": 0, "status": 1})
+    if subscription_record:
+        if subscription_record.get('status') in ('pending', 'active'):
+            await activate_course_subscription(session_id, stripe_subscription_id)
+    else:
+        # Handle one-time payment (shop products, etc.)
+        await db.payment_transactions.update_one(
+            {"session_id": session_id, "payment_status": {"$ne": "paid"}},
+            {"$set": {"payment_status": "paid", "paid_at": utcnow()}}
+        )
+        transaction = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
+        if transaction and not transaction.get('fulfilled_at'):
+            # Check if this is a course purchase (legacy)
+            if transaction.get('type') == 'course' and transaction.get('course_id'):
+                await db.user_courses.update_one(
+                    {"user_id": transaction['user_id'], "course_id": transaction['course_id']},
+                    {"$set": {
+                        "user_id": transaction['user_id'],
+                        "course_id": transaction['course_id']
+                    }, "$setOnInsert": {"purchased_at": utcnow()}},
+                    upsert=True
+                )
+                await refresh_user_entitlements(transaction['user_id'])
+            else:
+                # Subscription purchase - activate subscription
+                previous = await db.users.find_one_and_update(
+                    {"id": transaction['user_id']},
+                    with_token_bump({"$set": {"subscription_status": "active"}}),
+                    projection={"_id": 0, "subscription_status": 1}
+                )
+                evict_user(transaction['user_id'])
+                if previous and previous.get('subscription_status') != 'active':
+                    await bump_admin_counters(active_subscriptions=1)
+            
+            if await claim_fulfilment_step(db.payment_transactions, session_id, "counted"):
+                await bump_admin_counters(total_payments=1)
+                await record_rollup(
+                    paid_transactions=1,
+                    transaction_revenue_cents=round(transaction.get('amount', 0) * 100)
+                )
+            await db.payment_transactions.update_one(
+                {"session_id": session_id}, {"$set": {"fulfilled_at": utcnow()}}
+            )
+    
+    checkout_status_cache.invalidate(session_id)
+    payment_notifier.notify(session_id)
+
+async def sync_checkout_session(session_id: str) -> dict:
+    """Look the session up on Stripe, apply it locally if paid and return its status"""
     try:
-        session = stripe.checkout.Session.retrieve(session_id)
+        session = await stripe_gateway.call(stripe.checkout.Session.retrieve, session_id)
         payment_status = "paid" if session.payment_status == "paid" else "pending"
     except Exception as e:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    # Handle subscription checkout completion
     if payment_status == "paid":
-        # Check if this is a subscription
-        subscription_record = await db.subscriptions.find_one({"session_id": session_id})
-        if subscription_record and subscription_record.get('status') == 'pending':
-            # Update subscription record
-            stripe_subscription_id = session.subscription
-            await db.subscriptions.update_one(
-                {"session_id": session_id},
-                {"$set": {
-                    "status": "active",
-                    "stripe_subscription_id": stripe_subscription_id,
-                    "activated_at": datetime.now(timezone.utc).isoformat()
-                }}
-            )
-            
-            # Add course access to user
-            await db.user_courses.update_one(
-                {"user_id": subscription_record['user_id'], "course_id": subscription_record['course_id']},
-                {"$set": {
-                    "user_id": subscription_record['user_id'],
-                    "course_id": subscription_record['course_id'],
-                    "subscription_id": subscription_record['id'],
-                    "purchased_at": datetime.now(timezone.utc).isoformat()
-                }},
-                upsert=True
-            )
-        else:
-            # Handle one-time payment (shop products, etc.)
-            transaction = await db.payment_transactions.find_one({"session_id": session_id})
-            if transaction and transaction.get('payment_status') != 'paid':
-                await db.payment_transactions.update_one(
-                    {"session_id": session_id},
-                    {"$set": {"payment_status": "paid", "paid_at": datetime.now(timezone.utc).isoformat()}}
-                )
-                
-                # Check if this is a course purchase (legacy)
-                if transaction.get('type') == 'course' and transaction.get('course_id'):
-                    await db.user_courses.update_one(
-                        {"user_id": transaction['user_id'], "course_id": transaction['course_id']},
-                        {"$set": {
-                            "user_id": transaction['user_id'],
-                            "course_id": transaction['course_id'],
-                            "purchased_at": datetime.now(timezone.utc).isoformat()
-                        }},
-                        upsert=True
-                    )
-                else:
-                    # Subscription purchase - activate subscription
-                    await db.users.update_one(
-                        {"id": transaction['user_id']},
-                        {"$set": {"subscription_status": "active"}}
-                    )
+        await complete_checkout_session(session_id, session.subscription)
     
-    return {
+    status = {
         "status": session.status,
         "payment_status": payment_status,
         "amount_total": session.amount_total,
         "currency": session.currency
     }
+    if payment_status != "paid":
+        checkout_status_cache.set(session_id, status)
+    return status
+
+async def local_checkout_status(session_id: str) -> Optional[dict]:
+    """Status of a checkout as far as our own records know it.
+
+    None when the session has no local record; payment_status stays "pending"
+    until the webhook or a Stripe lookup has marked it paid.
+    """
+    record = await db.subscriptions.find_one(
+        {"session_id": session_id}, {"_id": 0, "amount": 1, "currency": 1, "status": 1, "activated_at": 1}
+    )
+    if record:
+        paid = record.get('status') == 'active' or record.get('activated_at') is not None
+    else:
+        record = await db.payment_transactions.find_one(
+            {"session_id": session_id}, {"_id": 0, "amount": 1, "currency": 1, "payment_status": 1}
+        )
+        if not record:
+            return None
+        paid = record.get('payment_status') == 'paid'
+    return {
+        "status": "complete" if paid else "open",
+        "payment_status": "paid" if paid else "pending",
+        "amount_total": round(record.get('amount', 0) * 100),
+        "currency": record.get('currency', 'eur')
+    }
+
+# Recent Stripe answers for checkout sessions that were not paid yet, keyed by session id
+checkout_status_cache = TTLCache(CHECKOUT_STATUS_TTL_SECONDS, 1024)
+# Stripe lookups in progress, shared by concurrent requests for the same session
+checkout_lookups: Dict[str, asyncio.Future] = {}
+
+async def checkout_session_status(session_id: str) -> dict:
+    """Status of a checkout session, asking Stripe as rarely as possible.
+
+    Sessions our records already show as paid are answered locally. Otherwise
+    a Stripe answer is reused for CHECKOUT_STATUS_TTL_SECONDS, and concurrent
+    lookups for one session wait on a single Stripe request.
+    """
+    status = await local_checkout_status(session_id)
+    if status is not None and status['payment_status'] == 'paid':
+        return status
+    status = checkout_status_cache.get(session_id)
+    if status is not None:
+        return status
+    
+    lookup = checkout_lookups.get(session_id)
+    if lookup is None:
+        lookup = asyncio.ensure_future(sync_checkout_session(session_id))
+        checkout_lookups[session_id] = lookup
+        lookup.add_done_callback(lambda _: checkout_lookups.pop(session_id, None))
+    # Shielded so one client disconnecting does not cancel the lookup for the others
+    return await asyncio.shield(lookup)
+
+class PaymentNotifier:
+    """Wakes requests waiting on a checkout session in this worker.
+
+    Waiters on other workers are not reached; they notice the completion on
+    their next periodic check of the database.
+    """
+
+    def __init__(self):
+        self._waiters: Dict[str, set] = {}
+
+    def subscribe(self, session_id: str) -> asyncio.Event:
+        event = asyncio.Event()
+        self._waiters.setdefault(session_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, session_id: str, event: asyncio.Event):
+        waiters = self._waiters.get(session_id)
+        if waiters is not None:
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[session_id]
+
+    def notify(self, session_id: str):
+        for event in self._waiters.get(session_id, ()):
+            event.set()
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._waiters),
+            "waiters": sum(len(waiters) for waiters in self._waiters.values())
+        }
+
+payment_notifier = PaymentNotifier()
+
+@api_router.get("/payments/status/{session_id}")
+async def get_payment_status(session_id: str, request: Request):
+    return await checkout_session_status(session_id)
+
+@api_router.get("/payments/status/{session_id}/wait")
+async def wait_for_payment_status(
+    session_id: str,
+    timeout: float = Query(25, ge=0, le=PAYMENT_WAIT_MAX_SECONDS)
+):
+    """Long-poll for a checkout to be paid.
+
+    Answers as soon as the webhook processor marks the session paid, checking
+    the database every PAYMENT_WAIT_CHECK_SECONDS for completions handled by
+    other workers. Only if the session is still unpaid at the timeout (or has
+    no local record) is Stripe asked, once.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    event = payment_notifier.subscribe(session_id)
+    try:
+        while True:
+            status = await local_checkout_status(session_id)
+            if status is None or status['payment_status'] == 'paid':
+                break
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                status = None
+                break
+            try:
+                await asyncio.wait_for(event.wait(), timeout=min(remaining, PAYMENT_WAIT_CHECK_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+    finally:
+        payment_notifier.unsubscribe(session_id, event)
+    
+    if status is not None:
+        return status
+    return await checkout_session_status(session_id)
 
 @api_router.get("/user/courses")
 async def get_user_courses(user: dict = Depends(get_current_user)):
@@ -1071,114 +2184,457 @@ async def get_user_courses(user: dict = Depends(get_current_user)):
     course_ids = [uc['course_id'] for uc in user_courses]
     
     # Get course details
-    courses = []
-    for course_id in course_ids:
-        course = await db.courses.find_one({"id": course_id}, {"_id": 0})
-        if course:
-            courses.append(course)
-    
-    return courses
+    courses_by_id = await fetch_courses_by_ids(course_ids)
+    return [courses_by_id[course_id] for course_id in course_ids if course_id in courses_by_id]
+
+# ============= STRIPE EVENTS =============
+
+def stripe_event_ordering_key(event: dict) -> str:
+    """Events sharing a key are processed strictly in order.
+
+    Everything that touches one Stripe subscription shares its id; events
+    without one are independent.
+    """
+    data = event.get('data', {}).get('object', {})
+    event_type = event.get('type', '')
+    if event_type.startswith('customer.subscription.'):
+        return data.get('id') or event['id']
+    return data.get('subscription') or event['id']
+
+async def process_stripe_event(event: dict):
+    """Apply one Stripe event. Raising makes the consumer retry it later."""
+    event_type = event.get('type', '')
+    data = event.get('data', {}).get('object', {})
+    
+    logging.info(f"Webhook event: {event_type}")
+    
+    if event_type == 'checkout.session.completed':
+        if data.get('mode') == 'subscription' or data.get('payment_status') == 'paid':
+            await complete_checkout_session(data.get('id'), data.get('subscription'))
+    
+    elif event_type == 'customer.subscription.deleted':
+        # Subscription was cancelled
+        stripe_sub_id = data.get('id')
+        subscription = await db.subscriptions.find_one({"stripe_subscription_id": stripe_sub_id})
+        if subscription:
+            await db.subscriptions.update_one(
+                {"stripe_subscription_id": stripe_sub_id},
+                {"$set": {
+                    "status": "cancelled",
+                    "cancelled_at": utcnow()
+                }}
+            )
+            # Remove course access
+            await db.user_courses.delete_one({
+                "user_id": subscription['user_id'],
+                "course_id": subscription['course_id']
+            })
+            await refresh_user_entitlements(subscription['user_id'])
+    
+    elif event_type == 'invoice.payment_failed':
+        # Payment failed - might want to notify user
+        stripe_sub_id = data.get('subscription')
+        if stripe_sub_id:
+            await db.subscriptions.update_one(
+                {"stripe_subscription_id": stripe_sub_id},
+                {"$set": {"payment_failed_at": utcnow()}}
+            )
+
+class StripeEventConsumer:
+    """Drains the stripe_events inbox in the background.
+
+    Each pass reads the oldest events that are ready to run, due for a retry
+    or with an expired lease, and groups them by ordering key. Keys are worked
+    on concurrently, up to `workers` at a time, while the events of one key
+    run one after another and only while no earlier event of the key is still
+    unprocessed; a failing event holds back the later events of its key until
+    it succeeds or is given up on. Events are
+    claimed with a lease, so several app workers can share the inbox and an
+    event held by a crashed worker is picked up again once its lease expires.
+    """
+
+    def __init__(self, workers: int, max_attempts: int, poll_seconds: float, batch_size: int = 200):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def notify(self):
+        """Wake the consumer for a freshly received event"""
+        self._wake.set()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "processed": self.processed,
+            "retried": self.retried,
+            "failed": self.failed
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                if await self.drain_once():
+                    continue
+            except Exception as e:
+                logging.error(f"Stripe event consumer failed: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def drain_once(self) -> bool:
+        """Process one batch. Returns True when there may be more ready work."""
+        now = utcnow()
+        events = await db.stripe_events.find(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "processing", "locked_until": {"$lte": now}}
+            ]},
+            {"_id": 0, "id": 1, "ordering_key": 1}
+        ).sort([("event_created", ASCENDING), ("received_at", ASCENDING)]).limit(self.batch_size).to_list(self.batch_size)
+        if not events:
+            return False
+        
+        # The unprocessed events of each key in order; a key only runs the
+        # ready events at the head of that list, anything after an event that
+        # is still backing off or leased elsewhere waits for it
+        unprocessed = await db.stripe_events.aggregate([
+            {"$match": {
+                "ordering_key": {"$in": list({event['ordering_key'] for event in events})},
+                "status": {"$in": ["pending", "processing"]}
+            }},
+            {"$sort": {"ordering_key": 1, "event_created": 1, "received_at": 1}},
+            {"$group": {"_id": "$ordering_key", "ids": {"$firstN": {"input": "$id", "n": self.batch_size}}}}
+        ]).to_list(None)
+        heads = {row['_id']: row['ids'] for row in unprocessed}
+        
+        queues: Dict[str, List[dict]] = {}
+        for event in events:
+            queue = queues.setdefault(event['ordering_key'], [])
+            ids = heads.get(event['ordering_key'], [])
+            if len(queue) < len(ids) and ids[len(queue)] == event['id']:
+                queue.append(event)
+        
+        semaphore = asyncio.Semaphore(self.workers)
+        progressed = 0
+        
+        async def run_queue(queue: List[dict]):
+            nonlocal progressed
+            async with semaphore:
+                for event in queue:
+                    if not await self._process(event, now):
+                        break
+                    progressed += 1
+        
+        await asyncio.gather(*(run_queue(queue) for queue in queues.values()))
+        return progressed > 0 and len(events) == self.batch_size
+
+    async def _process(self, event: dict, now: datetime) -> bool:
+        """Claim and apply one event. Returns False if later events of its key must wait."""
+        claimed = await db.stripe_events.find_one_and_update(
+            {"id": event['id'], "$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "processing", "locked_until": {"$lte": now}}
+            ]},
+            {
+                "$set": {"status": "processing", "locked_until": utcnow() + timedelta(seconds=STRIPE_EVENT_LEASE_SECONDS)},
+                "$inc": {"attempts": 1}
+            },
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if not claimed:
+            # Another worker got there first
+            return False
+        
+        try:
+            await process_stripe_event(json.loads(claimed['payload']))
+        except Exception as e:
+            attempts = claimed['attempts']
+            if attempts >= self.max_attempts:
+                logging.error(f"Stripe event {claimed['id']} failed after {attempts} attempts: {e}")
+                update = {"status": "failed", "failed_at": utcnow()}
+                self.failed += 1
+            else:
+                delay = min(STRIPE_EVENT_RETRY_BASE_SECONDS * 2 ** (attempts - 1), STRIPE_EVENT_RETRY_MAX_SECONDS)
+                logging.warning(f"Stripe event {claimed['id']} failed, retrying in {delay:.0f}s: {e}")
+                update = {"status": "pending", "next_attempt_at": utcnow() + timedelta(seconds=delay)}
+                self.retried += 1
+            await db.stripe_events.update_one(
+                {"id": claimed['id']},
+                {"$set": {**update, "last_error": str(e)}, "$unset": {"locked_until": ""}}
+            )
+            return update['status'] == 'failed'
+        
+        await db.stripe_events.update_one(
+            {"id": claimed['id']},
+            {"$set": {"status": "processed", "processed_at": utcnow()}, "$unset": {"locked_until": ""}}
+        )
+        self.processed += 1
+        return True
+
+stripe_event_consumer = StripeEventConsumer(
+    STRIPE_EVENT_WORKERS, STRIPE_EVENT_MAX_ATTEMPTS, STRIPE_EVENT_POLL_SECONDS
+)
+
+class StripeWebhookVerifier:
+    """Checks Stripe-Signature headers before a webhook body is parsed.
+
+    The HMAC is keyed with the endpoint secret once; each request only copies
+    the keyed state. Event ids accepted within the timestamp tolerance are
+    remembered, so a replayed delivery is answered without a database write.
+    Past the tolerance the timestamp check rejects it anyway, which bounds how
+    long ids need to be kept.
+    """
+
+    def __init__(self, secret: str, tolerance: int, max_entries: int = 10000):
+        self._mac = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256) if secret else None
+        self.tolerance = tolerance
+        self.max_entries = max_entries
+        self.rejected = 0
+        self.replays = 0
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self._mac is not None
+
+    def verify(self, body: bytes, header: Optional[str]) -> bool:
+        """True if `header` carries a valid v1 signature of `body` within the tolerance"""
+        timestamp = None
+        signatures = []
+        for item in (header or "").split(","):
+            key, _, value = item.strip().partition("=")
+            if key == "t":
+                timestamp = value
+            elif key == "v1":
+                signatures.append(value)
+        
+        if not timestamp or not timestamp.isdigit() or not signatures \
+                or abs(time.time() - int(timestamp)) > self.tolerance:
+            self.rejected += 1
+            return False
+        
+        mac = self._mac.copy()
+        mac.update(timestamp.encode('ascii') + b"." + body)
+        expected = mac.hexdigest()
+        if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+            self.rejected += 1
+            return False
+        return True
+
+    def seen(self, event_id: str) -> bool:
+        now = time.monotonic()
+        while self._seen:
+            oldest_id, expires = next(iter(self._seen.items()))
+            if expires > now:
+                break
+            del self._seen[oldest_id]
+        if event_id in self._seen:
+            self.replays += 1
+            return True
+        return False
+
+    def remember(self, event_id: str):
+        self._seen[event_id] = time.monotonic() + self.tolerance
+        self._seen.move_to_end(event_id)
+        if len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "rejected": self.rejected,
+            "replays": self.replays,
+            "remembered": len(self._seen)
+        }
+
+stripe_webhook_verifier = StripeWebhookVerifier(STRIPE_WEBHOOK_SECRET, STRIPE_WEBHOOK_TOLERANCE_SECONDS)
 
 @api_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request):
-    """Handle Stripe webhook events for subscriptions"""
-    body = await request.body()
+    """Receive a Stripe event into the stripe_events inbox.
+
+    Only stores the event and acknowledges; StripeEventConsumer applies it.
+    Redeliveries of an event already in the inbox are acknowledged without
+    being stored again. With STRIPE_WEBHOOK_SECRET set, requests without a
+    valid signature are rejected before the body is parsed.
+    """
     signature = request.headers.get("Stripe-Signature")
+    if stripe_webhook_verifier.enabled and not signature:
+        stripe_webhook_verifier.rejected += 1
+        raise HTTPException(status_code=400, detail="Nedostaje Stripe potpis")
+    
+    body = await request.body()
+    if stripe_webhook_verifier.enabled and not stripe_webhook_verifier.verify(body, signature):
+        raise HTTPException(status_code=400, detail="Nevažeći Stripe potpis")
     
-    # Note: In production, you should verify the webhook signature
     try:
         payload = body.decode('utf-8')
-        import json
         event = json.loads(payload)
-        
-        event_type = event.get('type', '')
-        data = event.get('data', {}).get('object', {})
-        
-        logging.info(f"Webhook event: {event_type}")
-        
-        if event_type == 'checkout.session.completed':
-            session_id = data.get('id')
-            if data.get('mode') == 'subscription':
-                # Handle subscription checkout completion
-                subscription_record = await db.subscriptions.find_one({"session_id": session_id})
-                if subscription_record:
-                    stripe_sub_id = data.get('subscription')
-                    await db.subscriptions.update_one(
-                        {"session_id": session_id},
-                        {"$set": {
-                            "status": "active",
-                            "stripe_subscription_id": stripe_sub_id,
-                            "activated_at": datetime.now(timezone.utc).isoformat()
-                        }}
-                    )
-                    # Grant course access
-                    await db.user_courses.update_one(
-                        {"user_id": subscription_record['user_id'], "course_id": subscription_record['course_id']},
-                        {"$set": {
-                            "user_id": subscription_record['user_id'],
-                            "course_id": subscription_record['course_id'],
-                            "subscription_id": subscription_record['id'],
-                            "purchased_at": datetime.now(timezone.utc).isoformat()
-                        }},
-                        upsert=True
-                    )
-                    
-                    # Credit affiliate commission (only first purchase)
-                    await credit_affiliate_commission(
-                        subscription_record['user_id'],
-                        subscription_record['amount'],
-                        subscription_record['course_id']
-                    )
-        
-        elif event_type == 'customer.subscription.deleted':
-            # Subscription was cancelled
-            stripe_sub_id = data.get('id')
-            subscription = await db.subscriptions.find_one({"stripe_subscription_id": stripe_sub_id})
-            if subscription:
-                await db.subscriptions.update_one(
-                    {"stripe_subscription_id": stripe_sub_id},
-                    {"$set": {
-                        "status": "cancelled",
-                        "cancelled_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                # Remove course access
-                await db.user_courses.delete_one({
-                    "user_id": subscription['user_id'],
-                    "course_id": subscription['course_id']
-                })
-        
-        elif event_type == 'invoice.payment_failed':
-            # Payment failed - might want to notify user
-            stripe_sub_id = data.get('subscription')
-            if stripe_sub_id:
-                await db.subscriptions.update_one(
-                    {"stripe_subscription_id": stripe_sub_id},
-                    {"$set": {"payment_failed_at": datetime.now(timezone.utc).isoformat()}}
-                )
-        
-        return {"status": "ok"}
-    except Exception as e:
-        logging.error(f"Webhook error: {e}")
-        return {"status": "error", "message": str(e)}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Nevažeći webhook payload")
+    if not isinstance(event, dict) or not event.get('id') or not event.get('type'):
+        raise HTTPException(status_code=400, detail="Nevažeći webhook payload")
+    if stripe_webhook_verifier.seen(event['id']):
+        return {"status": "duplicate"}
+    
+    now = utcnow()
+    created = event.get('created')
+    try:
+        await db.stripe_events.insert_one({
+            "id": event['id'],
+            "type": event['type'],
+            "ordering_key": stripe_event_ordering_key(event),
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "event_created": datetime.fromtimestamp(created, timezone.utc) if isinstance(created, (int, float)) else now,
+            "received_at": now,
+            "next_attempt_at": now
+        })
+    except DuplicateKeyError:
+        stripe_webhook_verifier.remember(event['id'])
+        return {"status": "duplicate"}
+    
+    stripe_webhook_verifier.remember(event['id'])
+    stripe_event_consumer.notify()
+    return {"status": "ok"}
+
+# ============= PAGINATION =============
+
+ADMIN_PAGE_SIZE = 100
+ADMIN_MAX_PAGE_SIZE = 500
+
+def encode_cursor(values: list) -> str:
+    # Extended JSON keeps sort values such as dates typed across the round trip
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str, length: int) -> list:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Nevažeći kursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise HTTPException(status_code=400, detail="Nevažeći kursor")
+    return values
+
+def keyset_after(sort: List[tuple], values: list) -> dict:
+    """Filter matching documents strictly after `values` in the given sort order"""
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {prev_field: value for (prev_field, _), value in zip(sort[:i], values[:i])}
+        clause[field] = {"$lt" if direction == DESCENDING else "$gt": values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+async def fetch_page(collection, query: dict, sort: List[tuple], limit: int,
+                     cursor: Optional[str] = None, projection: Optional[dict] = None):
+    """Fetch one keyset page. Returns (items, cursor for the next page or None)"""
+    if cursor:
+        query = {"$and": [query, keyset_after(sort, decode_cursor(cursor, len(sort)))]}
+    items = await collection.find(query, projection).sort(sort).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor([items[-1].get(field) for field, _ in sort])
+    return items, next_cursor
+
+async def aggregate_page(collection, query: dict, sort: List[tuple], limit: int,
+                         cursor: Optional[str] = None, stages: Optional[List[dict]] = None):
+    """Like fetch_page, but runs the extra pipeline `stages` (joins, projections)
+    only on the documents of the requested page, in a single aggregation."""
+    if cursor:
+        query = {"$and": [query, keyset_after(sort, decode_cursor(cursor, len(sort)))]}
+    pipeline = [{"$match": query}, {"$sort": dict(sort)}, {"$limit": limit + 1}, *(stages or [])]
+    items = await collection.aggregate(pipeline).to_list(limit + 1)
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor([items[-1].get(field) for field, _ in sort])
+    return items, next_cursor
+
+def lookup_one(from_collection: str, local_field: str, as_field: str, projection: dict) -> List[dict]:
+    """$lookup stages joining a single document by its `id`, or null when it does not exist"""
+    return [
+        {"$lookup": {
+            "from": from_collection,
+            "localField": local_field,
+            "foreignField": "id",
+            "pipeline": [{"$limit": 1}, {"$project": projection}],
+            "as": as_field
+        }},
+        {"$set": {as_field: {"$ifNull": [{"$arrayElemAt": [f"${as_field}", 0]}, None]}}}
+    ]
+
+def day_range_filter(start: Optional[date], end: Optional[date]) -> Optional[dict]:
+    """Filter for timestamps from the start of `start` through the end of `end` (UTC, inclusive)"""
+    bounds = {}
+    if start:
+        bounds["$gte"] = datetime(start.year, start.month, start.day, tzinfo=timezone.utc)
+    if end:
+        bounds["$lt"] = datetime(end.year, end.month, end.day, tzinfo=timezone.utc) + timedelta(days=1)
+    return bounds or None
+
+async def ndjson_lines(cursor):
+    """Stream a MongoDB cursor as newline-delimited JSON, one document at a time"""
+    async for doc in cursor:
+        yield json.dumps(jsonable_encoder(doc), ensure_ascii=False) + "\n"
 
 # ============= ADMIN SUBSCRIPTION MANAGEMENT =============
 
+SUBSCRIPTIONS_SORT = [("created_at", DESCENDING), ("id", DESCENDING)]
+
 @api_router.get("/admin/subscriptions")
-async def get_all_subscriptions(admin: dict = Depends(get_admin_user)):
-    """Get all active subscriptions"""
-    subscriptions = await db.subscriptions.find(
-        {"status": "active"}, 
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(500)
-    
-    # Enrich with user and course info
-    for sub in subscriptions:
-        user = await db.users.find_one({"id": sub['user_id']}, {"_id": 0, "password": 0})
-        course = await db.courses.find_one({"id": sub['course_id']}, {"_id": 0})
-        sub['user'] = user
-        sub['course'] = course
-    
+async def get_all_subscriptions(
+    response: Response,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    course_id: Optional[str] = None,
+    created_from: Optional[date] = None,
+    created_to: Optional[date] = None,
+    admin: dict = Depends(get_admin_user)
+):
+    """Get active subscriptions with user and course info, newest first.
+
+    One aggregation per page joins users and courses; the next page cursor is
+    returned in X-Next-Cursor.
+    """
+    query: Dict[str, Any] = {"status": "active"}
+    if course_id:
+        query['course_id'] = course_id
+    created_range = day_range_filter(created_from, created_to)
+    if created_range:
+        query['created_at'] = created_range
+    
+    subscriptions, next_cursor = await aggregate_page(
+        db.subscriptions, query, SUBSCRIPTIONS_SORT, limit, cursor,
+        stages=[
+            *lookup_one("users", "user_id", "user", {"_id": 0, "password": 0, "token_version": 0, "token_changed_at": 0}),
+            *lookup_one("courses", "course_id", "course", {"_id": 0}),
+            {"$project": {"_id": 0}}
+        ]
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return subscriptions
 
 @api_router.post("/admin/cancel-subscription")
@@ -1203,7 +2659,7 @@ async def admin_cancel_subscription(data: CancelSubscriptionRequest, admin: dict
     stripe_sub_id = subscription.get('stripe_subscription_id')
     if stripe_sub_id:
         try:
-            stripe.Subscription.cancel(stripe_sub_id)
+            await stripe_gateway.call(stripe.Subscription.cancel, stripe_sub_id)
         except Exception as e:
             logging.error(f"Stripe cancellation error: {e}")
             # Continue anyway to update local records
@@ -1213,7 +2669,7 @@ async def admin_cancel_subscription(data: CancelSubscriptionRequest, admin: dict
         {"id": subscription['id']},
         {"$set": {
             "status": "cancelled",
-            "cancelled_at": datetime.now(timezone.utc).isoformat(),
+            "cancelled_at": utcnow(),
             "cancelled_by": admin['email']
         }}
     )
@@ -1223,36 +2679,195 @@ async def admin_cancel_subscription(data: CancelSubscriptionRequest, admin: dict
         "user_id": user['id'],
         "course_id": data.course_id
     })
+    await refresh_user_entitlements(user['id'])
     
     course = await db.courses.find_one({"id": data.course_id}, {"_id": 0})
     course_title = course['title'] if course else 'Nepoznat kurs'
     
     return {"message": f"Pretplata za '{course_title}' otkazana za korisnika {data.user_email}"}
 
+# ============= ANALYTICS =============
+
+ROLLUP_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m"}
+ROLLUP_METRICS = [
+    "signups",
+    "paid_transactions",
+    "transaction_revenue_cents",
+    "subscriptions_activated",
+    "subscription_revenue_cents",
+]
+
+async def record_rollup(when: Optional[datetime] = None, **increments: int):
+    """Add an event's increments to its day and month bucket documents"""
+    when = when or utcnow()
+    await db.analytics_rollups.bulk_write([
+        UpdateOne(
+            {"granularity": granularity, "bucket": when.strftime(fmt)},
+            {"$inc": increments},
+            upsert=True
+        )
+        for granularity, fmt in ROLLUP_FORMATS.items()
+    ], ordered=False)
+
+def rollup_buckets(granularity: str, start: date, end: date) -> List[str]:
+    """Every bucket key from start to end inclusive"""
+    buckets = []
+    if granularity == "day":
+        current = start
+        while current <= end:
+            buckets.append(current.strftime(ROLLUP_FORMATS["day"]))
+            current += timedelta(days=1)
+    else:
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            buckets.append(f"{year:04d}-{month:02d}")
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return buckets
+
+def rollup_summary(values: dict) -> dict:
+    purchases = values['paid_transactions'] + values['subscriptions_activated']
+    return {
+        "signups": values['signups'],
+        "paid_transactions": values['paid_transactions'],
+        "subscriptions_activated": values['subscriptions_activated'],
+        "revenue": round((values['transaction_revenue_cents'] + values['subscription_revenue_cents']) / 100, 2),
+        "transaction_revenue": round(values['transaction_revenue_cents'] / 100, 2),
+        "subscription_revenue": round(values['subscription_revenue_cents'] / 100, 2),
+        "conversion_rate": round(purchases / values['signups'], 4) if values['signups'] else None
+    }
+
+@api_router.get("/admin/analytics")
+async def get_admin_analytics(
+    granularity: str = Query("day", pattern="^(day|month)$"),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    admin: dict = Depends(get_admin_user)
+):
+    """Revenue, signups and conversions per day or month, read from the rollup buckets"""
+    end = end or utcnow().date()
+    start = start or (end - timedelta(days=29) if granularity == "day" else date(end.year - 1, end.month, 1))
+    if start > end:
+        raise HTTPException(status_code=400, detail="Početni datum mora biti prije krajnjeg")
+    if granularity == "day" and (end - start).days > 366:
+        raise HTTPException(status_code=400, detail="Maksimalni raspon za dnevni prikaz je godinu dana")
+    
+    buckets = rollup_buckets(granularity, start, end)
+    docs = await db.analytics_rollups.find(
+        {"granularity": granularity, "bucket": {"$gte": buckets[0], "$lte": buckets[-1]}},
+        {"_id": 0}
+    ).to_list(None)
+    by_bucket = {doc['bucket']: doc for doc in docs}
+    
+    series = []
+    totals = {metric: 0 for metric in ROLLUP_METRICS}
+    for bucket in buckets:
+        doc = by_bucket.get(bucket, {})
+        values = {metric: doc.get(metric, 0) for metric in ROLLUP_METRICS}
+        for metric, value in values.items():
+            totals[metric] += value
+        series.append({"bucket": bucket, **rollup_summary(values)})
+    
+    return {
+        "granularity": granularity,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "series": series,
+        "totals": rollup_summary(totals)
+    }
+
+# ============= ADMIN COUNTERS =============
+
+ADMIN_COUNTERS_RECONCILE_SECONDS = float(os.environ.get('ADMIN_COUNTERS_RECONCILE_SECONDS', '3600'))
+AFFILIATE_LEDGER_VERIFY_SECONDS = float(os.environ.get('AFFILIATE_LEDGER_VERIFY_SECONDS', '3600'))
+
+async def bump_admin_counters(**deltas: int):
+    """Apply write-path deltas to the admin dashboard counters document"""
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if deltas:
+        await db.admin_counters.update_one({"id": "main"}, {"$inc": deltas}, upsert=True)
+
+async def reconcile_admin_counters() -> dict:
+    """Recount everything from the source collections and overwrite the counters"""
+    counters = {
+        "total_users": await db.users.count_documents({}),
+        "active_subscriptions": await db.users.count_documents({"subscription_status": "active"}),
+        "total_courses": await db.courses.count_documents({}),
+        "total_payments": await db.payment_transactions.count_documents({"payment_status": "paid"}),
+        "reconciled_at": utcnow()
+    }
+    await db.admin_counters.update_one({"id": "main"}, {"$set": counters}, upsert=True)
+    return counters
+
 # ============= ADMIN ROUTES =============
 
 @api_router.get("/admin/stats")
 async def get_admin_stats(admin: dict = Depends(get_admin_user)):
-    total_users = await db.users.count_documents({})
-    active_subs = await db.users.count_documents({"subscription_status": "active"})
-    total_courses = await db.courses.count_documents({})
-    total_payments = await db.payment_transactions.count_documents({"payment_status": "paid"})
+    counters = await db.admin_counters.find_one({"id": "main"}, {"_id": 0})
+    if not counters:
+        counters = await reconcile_admin_counters()
     
-    recent_users = await db.users.find({}, {"_id": 0, "password": 0}).sort("created_at", -1).limit(10).to_list(10)
+    recent_users = await db.users.find({}, {"_id": 0, "password": 0, "token_version": 0, "token_changed_at": 0}).sort("created_at", -1).limit(10).to_list(10)
     recent_payments = await db.payment_transactions.find({"payment_status": "paid"}, {"_id": 0}).sort("paid_at", -1).limit(10).to_list(10)
     
     return {
-        "total_users": total_users,
-        "active_subscriptions": active_subs,
-        "total_courses": total_courses,
-        "total_payments": total_payments,
+        "total_users": counters.get('total_users', 0),
+        "active_subscriptions": counters.get('active_subscriptions', 0),
+        "total_courses": counters.get('total_courses', 0),
+        "total_payments": counters.get('total_payments', 0),
         "recent_users": recent_users,
         "recent_payments": recent_payments
     }
 
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(admin: dict = Depends(get_admin_user)):
+    """Runtime metrics for the worker serving this request"""
+    return {
+        "password_hasher": password_hasher.stats(),
+        "stripe_gateway": stripe_gateway.stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "catalog_listener": catalog_listener.stats(),
+        "stripe_events": stripe_event_consumer.stats(),
+        "stripe_webhook": stripe_webhook_verifier.stats(),
+        "payment_waiters": payment_notifier.stats(),
+        "checkout_status_cache": {**checkout_status_cache.stats(), "in_flight": len(checkout_lookups)},
+        "user_cache": user_cache.stats(),
+        "recaptcha": recaptcha_verifier.stats()
+    }
+
+USERS_SORT = [("created_at", DESCENDING), ("id", DESCENDING)]
+
 @api_router.get("/admin/users")
-async def get_all_users(admin: dict = Depends(get_admin_user)):
-    users = await db.users.find({}, {"_id": 0, "password": 0}).to_list(1000)
+async def get_all_users(
+    response: Response,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    email_prefix: Optional[str] = None,
+    role: Optional[str] = None,
+    subscription_status: Optional[str] = None,
+    export_format: str = Query("json", alias="format", pattern="^(json|ndjson)$"),
+    admin: dict = Depends(get_admin_user)
+):
+    """Newest users first, one keyset page at a time (next page cursor in X-Next-Cursor).
+
+    format=ndjson streams every matching user instead, without buffering the
+    collection in memory.
+    """
+    query: Dict[str, Any] = {}
+    if email_prefix:
+        query['email'] = {"$regex": f"^{re.escape(email_prefix)}"}
+    if role:
+        query['role'] = role
+    if subscription_status:
+        query['subscription_status'] = subscription_status
+    projection = {"_id": 0, "password": 0, "token_version": 0, "token_changed_at": 0}
+    
+    if export_format == "ndjson":
+        export_cursor = db.users.find(query, projection).sort(USERS_SORT).batch_size(ADMIN_MAX_PAGE_SIZE)
+        return StreamingResponse(ndjson_lines(export_cursor), media_type="application/x-ndjson")
+    
+    users, next_cursor = await fetch_page(db.users, query, USERS_SORT, limit, cursor, projection)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return users
 
 @api_router.put("/admin/users/{user_id}/subscription")
@@ -1260,20 +2875,34 @@ async def update_user_subscription(user_id: str, status: str, admin: dict = Depe
     if status not in ["active", "inactive"]:
         raise HTTPException(status_code=400, detail="Nevažeći status")
     
-    result = await db.users.update_one(
+    previous = await db.users.find_one_and_update(
         {"id": user_id},
-        {"$set": {"subscription_status": status}}
+        with_token_bump({"$set": {"subscription_status": status}}),
+        projection={"_id": 0, "subscription_status": 1}
     )
-    if result.matched_count == 0:
+    if not previous:
         raise HTTPException(status_code=404, detail="Korisnik nije pronađen")
+    evict_user(user_id)
+    
+    was_active = previous.get('subscription_status') == 'active'
+    if was_active != (status == 'active'):
+        await bump_admin_counters(active_subscriptions=1 if status == 'active' else -1)
     
     return {"message": f"Status pretplate ažuriran na {status}"}
 
 @api_router.delete("/admin/users/{user_id}")
 async def delete_user(user_id: str, admin: dict = Depends(get_admin_user)):
-    result = await db.users.delete_one({"id": user_id})
-    if result.deleted_count == 0:
+    deleted = await db.users.find_one_and_delete(
+        {"id": user_id}, projection={"_id": 0, "subscription_status": 1}
+    )
+    if not deleted:
         raise HTTPException(status_code=404, detail="Korisnik nije pronađen")
+    await notify_user_deleted(user_id)
+    await bump_admin_counters(
+        total_users=-1,
+        active_subscriptions=-1 if deleted.get('subscription_status') == 'active' else 0
+    )
+    await db.user_entitlements.delete_one({"user_id": user_id})
     return {"message": "Korisnik obrisan"}
 
 # ============= CONTACT ROUTES =============
@@ -1283,7 +2912,7 @@ async def submit_contact(data: ContactMessage):
     message = {
         "id": str(uuid.uuid4()),
         **data.model_dump(),
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": utcnow(),
         "read": False
     }
     await db.contact_messages.insert_one(message)
@@ -1294,6 +2923,223 @@ async def get_messages(admin: dict = Depends(get_admin_user)):
     messages = await db.contact_messages.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
     return messages
 
+# ============= AFFILIATE LEDGER =============
+
+# Affiliate money is kept as an append-only, double-entry journal in
+# affiliate_ledger. Every entry moves an amount between two accounts, so its
+# postings sum to zero. users.affiliate_balance / total_earned are the
+# projection of the journal: each movement is posted and then $inc-ed onto
+# the user, and AffiliateLedgerVerifier recomputes them to catch drift.
+LEDGER_COMMISSIONS = "expense:affiliate_commissions"
+LEDGER_PAYOUTS_PENDING = "liability:affiliate_payouts_pending"
+LEDGER_PAYOUTS_PAID = "asset:affiliate_payouts_paid"
+LEDGER_OPENING_BALANCES = "equity:opening_balances"
+# Balances are euro floats; differences below a cent are rounding noise
+LEDGER_TOLERANCE = 0.005
+
+def affiliate_account(user_id: str) -> str:
+    return f"affiliate:{user_id}"
+
+def ledger_transfer(from_account: str, to_account: str, amount: float) -> List[dict]:
+    return [
+        {"account": from_account, "amount": -amount},
+        {"account": to_account, "amount": amount}
+    ]
+
+def ledger_postings(kind: str, user_id: str, amount: float) -> List[dict]:
+    """Postings for a ledger entry of `kind` moving `amount`"""
+    account = affiliate_account(user_id)
+    if kind == "commission":
+        return ledger_transfer(LEDGER_COMMISSIONS, account, amount)
+    if kind == "opening_balance":
+        return ledger_transfer(LEDGER_OPENING_BALANCES, account, amount)
+    if kind == "payout_request":
+        return ledger_transfer(account, LEDGER_PAYOUTS_PENDING, amount)
+    if kind == "opening_payout":
+        return ledger_transfer(LEDGER_OPENING_BALANCES, LEDGER_PAYOUTS_PENDING, amount)
+    if kind == "payout_rejected":
+        return ledger_transfer(LEDGER_PAYOUTS_PENDING, account, amount)
+    if kind == "payout_completed":
+        return ledger_transfer(LEDGER_PAYOUTS_PENDING, LEDGER_PAYOUTS_PAID, amount)
+    raise ValueError(f"Unknown ledger entry kind: {kind}")
+
+def ledger_entry(user_id: str, kind: str, amount: float, reference_id: str, earned: float = 0.0) -> dict:
+    postings = ledger_postings(kind, user_id, amount)
+    account = affiliate_account(user_id)
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "kind": kind,
+        # Effect on the affiliate's balance, kept alongside the postings for simple sums
+        "amount": sum(p['amount'] for p in postings if p['account'] == account),
+        "earned": earned,
+        "postings": postings,
+        "reference_id": reference_id,
+        "created_at": utcnow()
+    }
+
+async def post_affiliate_entry(user_id: str, kind: str, amount: float, reference_id: str,
+                               earned: float = 0.0) -> bool:
+    """Append one journal entry. (kind, reference_id) is unique: returns False,
+    without writing, if the movement was already posted."""
+    try:
+        await db.affiliate_ledger.insert_one(ledger_entry(user_id, kind, amount, reference_id, earned))
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def ledger_totals(user_ids: List[str]) -> Dict[str, dict]:
+    """Balance and total earned per user as the journal has them"""
+    rows = await db.affiliate_ledger.aggregate([
+        {"$match": {"user_id": {"$in": user_ids}}},
+        {"$group": {
+            "_id": "$user_id",
+            "balance": {"$sum": "$amount"},
+            "earned": {"$sum": "$earned"},
+            "unbalanced": {"$sum": {"$cond": [
+                {"$gt": [{"$abs": {"$sum": "$postings.amount"}}, LEDGER_TOLERANCE]}, 1, 0
+            ]}}
+        }}
+    ]).to_list(None)
+    return {row['_id']: row for row in rows}
+
+async def stream_affiliates(batch_size: int):
+    """Affiliates with any balance history, in batches of `batch_size`"""
+    batch = []
+    cursor = db.users.find(
+        AFFILIATE_ACTIVITY_FILTER,
+        {"_id": 0, "id": 1, "email": 1, "affiliate_balance": 1, "total_earned": 1}
+    ).batch_size(batch_size)
+    async for user in cursor:
+        batch.append(user)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def open_affiliate_ledger(batch_size: int = 500) -> dict:
+    """Bring balances from before the journal into it. Safe to re-run.
+
+    Entries written before they carried postings are completed, and every
+    affiliate gets an opening_balance entry for whatever their projection
+    holds beyond the journal, so the two agree from then on. Payouts still
+    pending from before the journal get an opening_payout entry, so the
+    pending liability covers them.
+    """
+    upgraded = 0
+    async for entry in db.affiliate_ledger.find({"postings": {"$exists": False}}, {"_id": 0}):
+        await db.affiliate_ledger.update_one(
+            {"id": entry['id']},
+            {"$set": {
+                "postings": ledger_postings(entry['kind'], entry['user_id'], abs(entry['amount'])),
+                "earned": entry['amount'] if entry['kind'] == 'commission' else 0.0
+            }}
+        )
+        upgraded += 1
+    
+    opened = 0
+    async for batch in stream_affiliates(batch_size):
+        user_ids = [user['id'] for user in batch]
+        already_opened = set(await db.affiliate_ledger.distinct(
+            "user_id", {"kind": "opening_balance", "user_id": {"$in": user_ids}}
+        ))
+        totals = await ledger_totals(user_ids)
+        for user in batch:
+            if user['id'] in already_opened:
+                continue
+            ledger = totals.get(user['id'], {"balance": 0.0, "earned": 0.0})
+            balance = user.get('affiliate_balance', 0.0) - ledger['balance']
+            earned = user.get('total_earned', 0.0) - ledger['earned']
+            if abs(balance) > LEDGER_TOLERANCE or abs(earned) > LEDGER_TOLERANCE:
+                if await post_affiliate_entry(user['id'], "opening_balance", balance, user['id'], earned):
+                    opened += 1
+    
+    opened_payouts = 0
+    async for payout in db.affiliate_payouts.find({"status": "pending"}, {"_id": 0, "id": 1, "user_id": 1, "amount": 1}):
+        if await db.affiliate_ledger.find_one({"kind": "payout_request", "reference_id": payout['id']}, {"_id": 1}):
+            continue
+        if await post_affiliate_entry(payout['user_id'], "opening_payout", payout['amount'], payout['id']):
+            opened_payouts += 1
+    return {"entries_upgraded": upgraded, "opening_balances": opened, "opening_payouts": opened_payouts}
+
+class AffiliateLedgerVerifier:
+    """Recomputes affiliate balances from the journal and flags drift.
+
+    Streams affiliates in batches and sums each batch's journal entries in
+    one $group, so memory stays flat however large the ledger gets. The
+    pending payouts liability is checked against the payouts actually
+    pending. A movement caught between its journal entry and its $inc shows
+    as drift until the next run. The last report is kept for the admin endpoint.
+    """
+
+    def __init__(self, batch_size: int = 500, max_reported: int = 100):
+        self.batch_size = batch_size
+        self.max_reported = max_reported
+        self.last_report: Optional[dict] = None
+
+    async def run(self) -> dict:
+        started = time.perf_counter()
+        checked = 0
+        unbalanced = 0
+        drift = []
+        async for batch in stream_affiliates(self.batch_size):
+            totals = await ledger_totals([user['id'] for user in batch])
+            for user in batch:
+                checked += 1
+                ledger = totals.get(user['id'], {"balance": 0.0, "earned": 0.0, "unbalanced": 0})
+                unbalanced += ledger['unbalanced']
+                balance = user.get('affiliate_balance', 0.0)
+                earned = user.get('total_earned', 0.0)
+                if abs(balance - ledger['balance']) > LEDGER_TOLERANCE or abs(earned - ledger['earned']) > LEDGER_TOLERANCE:
+                    drift.append({
+                        "user_id": user['id'],
+                        "email": user.get('email'),
+                        "affiliate_balance": balance,
+                        "ledger_balance": round(ledger['balance'], 2),
+                        "total_earned": earned,
+                        "ledger_earned": round(ledger['earned'], 2)
+                    })
+        
+        pending = await self.pending_payouts()
+        if drift or unbalanced or pending['drift']:
+            logging.warning(
+                f"Affiliate ledger drift: {len(drift)} affiliates, {unbalanced} unbalanced entries, "
+                f"pending payouts {pending['payouts']} vs ledger {pending['ledger']}"
+            )
+        self.last_report = {
+            "checked_at": utcnow(),
+            "affiliates_checked": checked,
+            "unbalanced_entries": unbalanced,
+            "drift_count": len(drift),
+            "drift": drift[:self.max_reported],
+            "pending_payouts": pending,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+        return self.last_report
+
+    async def pending_payouts(self) -> dict:
+        """Pending payouts liability in the journal against the pending payout requests"""
+        ledger = await db.affiliate_ledger.aggregate([
+            {"$match": {"postings.account": LEDGER_PAYOUTS_PENDING}},
+            {"$unwind": "$postings"},
+            {"$match": {"postings.account": LEDGER_PAYOUTS_PENDING}},
+            {"$group": {"_id": None, "balance": {"$sum": "$postings.amount"}}}
+        ]).to_list(1)
+        payouts = await db.affiliate_payouts.aggregate([
+            {"$match": {"status": "pending"}},
+            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+        ]).to_list(1)
+        ledger_balance = ledger[0]['balance'] if ledger else 0.0
+        payouts_total = payouts[0]['total'] if payouts else 0.0
+        return {
+            "payouts": round(float(payouts_total), 2),
+            "ledger": round(float(ledger_balance), 2),
+            "drift": abs(payouts_total - ledger_balance) > LEDGER_TOLERANCE
+        }
+
+affiliate_ledger_verifier = AffiliateLedgerVerifier()
+
 # ============= AFFILIATE ROUTES =============
 
 @api_router.get("/affiliate/stats")
@@ -1301,19 +3147,7 @@ async def get_affiliate_stats(user: dict = Depends(get_current_user)):
     """Get affiliate stats for current user"""
     # Generate affiliate code if user doesn't have one
     if not user.get('affiliate_code'):
-        affiliate_code = generate_affiliate_code()
-        while await db.users.find_one({"affiliate_code": affiliate_code}):
-            affiliate_code = generate_affiliate_code()
-        await db.users.update_one(
-            {"id": user['id']},
-            {"$set": {
-                "affiliate_code": affiliate_code,
-                "affiliate_balance": user.get('affiliate_balance', 0.0),
-                "total_earned": user.get('total_earned', 0.0),
-                "total_referrals": user.get('total_referrals', 0)
-            }}
-        )
-        user['affiliate_code'] = affiliate_code
+        user['affiliate_code'] = await assign_affiliate_code(user['id'])
     
     settings = await db.site_settings.find_one({}, {"_id": 0})
     commission_percent = settings.get('affiliate_commission_percent', 25.0) if settings else 25.0
@@ -1356,7 +3190,7 @@ async def track_affiliate_click(affiliate_code: str, request: Request):
         "affiliate_code": affiliate_code,
         "affiliate_user_id": affiliate_user['id'],
         "ip": request.client.host if request.client else "unknown",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utcnow()
     }
     await db.affiliate_clicks.insert_one(click_log)
     
@@ -1376,11 +3210,12 @@ async def update_payout_method(data: AffiliatePayoutMethodUpdate, user: dict = D
     
     await db.users.update_one(
         {"id": user['id']},
-        {"$set": {
+        with_token_bump({"$set": {
             "payout_method": data.payout_method,
             "payout_details": data.payout_details
-        }}
+        }})
     )
+    evict_user(user['id'])
     
     return {"message": f"Metoda isplate ažurirana na {data.payout_method}"}
 
@@ -1389,22 +3224,23 @@ async def request_affiliate_payout(data: AffiliatePayoutRequest, user: dict = De
     """Request manual payout of affiliate earnings (minimum 50€)"""
     MIN_PAYOUT = 50.0
     
-    if user.get('affiliate_balance', 0) < data.amount:
-        raise HTTPException(status_code=400, detail="Nedovoljno sredstava")
-    
     if data.amount < MIN_PAYOUT:
         raise HTTPException(status_code=400, detail=f"Minimalni iznos za isplatu je €{MIN_PAYOUT}")
     
     if not user.get('payout_method') or not user.get('payout_details'):
         raise HTTPException(status_code=400, detail="Molimo prvo unesite podatke za isplatu (PayPal, Wise ili IBAN)")
     
-    # Check for existing pending payout
-    existing_pending = await db.affiliate_payouts.find_one({
-        "user_id": user['id'],
-        "status": "pending"
-    })
-    if existing_pending:
-        raise HTTPException(status_code=400, detail="Već imate zahtjev za isplatu na čekanju")
+    # Debit only if the balance covers it; concurrent requests and commission
+    # credits each apply their own $inc, so none of them is lost
+    debited = await db.users.find_one_and_update(
+        {"id": user['id'], "affiliate_balance": {"$gte": data.amount}},
+        with_token_bump({"$inc": {"affiliate_balance": -data.amount}}),
+        projection={"_id": 0, "affiliate_balance": 1, "payout_method": 1, "payout_details": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not debited:
+        raise HTTPException(status_code=400, detail="Nedovoljno sredstava")
+    evict_user(user['id'])
     
     # Create payout request
     payout_request = {
@@ -1413,40 +3249,34 @@ async def request_affiliate_payout(data: AffiliatePayoutRequest, user: dict = De
         "user_email": user['email'],
         "user_name": user['name'],
         "amount": data.amount,
-        "payout_method": user['payout_method'],
-        "payout_details": user['payout_details'],
+        # Current details from the debited document, the user dict may be cached
+        "payout_method": debited.get('payout_method') or user['payout_method'],
+        "payout_details": debited.get('payout_details') or user['payout_details'],
         "status": "pending",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utcnow()
     }
-    await db.affiliate_payouts.insert_one(payout_request)
+    try:
+        await db.affiliate_payouts.insert_one(payout_request)
+    except DuplicateKeyError:
+        # The partial unique index allows one pending payout per user
+        await db.users.update_one({"id": user['id']}, with_token_bump({"$inc": {"affiliate_balance": data.amount}}))
+        evict_user(user['id'])
+        raise HTTPException(status_code=400, detail="Već imate zahtjev za isplatu na čekanju")
     
-    # Deduct from balance
-    new_balance = user.get('affiliate_balance', 0) - data.amount
-    await db.users.update_one(
-        {"id": user['id']},
-        {"$set": {"affiliate_balance": new_balance}}
-    )
+    await post_affiliate_entry(user['id'], "payout_request", data.amount, payout_request['id'])
     
     return {
         "message": f"Zahtjev za isplatu €{data.amount} je poslan. Admin će obraditi vaš zahtjev.",
-        "new_balance": new_balance
+        "new_balance": debited['affiliate_balance']
     }
 
 async def credit_affiliate_commission(buyer_user_id: str, amount: float, course_id: str):
-    """Credit affiliate commission when someone makes a purchase"""
+    """Credit affiliate commission when someone makes a purchase. Safe to retry"""
     # Get the buyer
     buyer = await db.users.find_one({"id": buyer_user_id}, {"_id": 0})
     if not buyer or not buyer.get('referred_by'):
         return
     
-    # Check if this is first purchase for this course (not renewal)
-    existing_purchase = await db.affiliate_referrals.find_one({
-        "referred_user_id": buyer_user_id,
-        "course_id": course_id
-    })
-    if existing_purchase:
-        return  # Already credited for this course
-    
     # Get affiliate user
     affiliate = await db.users.find_one({"id": buyer['referred_by']}, {"_id": 0})
     if not affiliate:
@@ -1458,30 +3288,46 @@ async def credit_affiliate_commission(buyer_user_id: str, amount: float, course_
     
     commission = amount * (commission_percent / 100)
     
-    # Update affiliate balance
-    await db.users.update_one(
-        {"id": affiliate['id']},
-        {
-            "$inc": {
-                "affiliate_balance": commission,
-                "total_earned": commission,
-                "total_referrals": 1
-            }
-        }
-    )
-    
-    # Log the referral
+    # Log the referral first: its unique (referred_user_id, course_id) index lets
+    # exactly one referral exist per first purchase of a course. The id doubles
+    # as the ledger reference, so it is derived from the purchase, not random
     referral_log = {
-        "id": str(uuid.uuid4()),
+        "id": f"{buyer_user_id}:{course_id}",
         "affiliate_user_id": affiliate['id'],
         "referred_user_id": buyer_user_id,
         "course_id": course_id,
         "purchase_amount": amount,
         "commission_amount": commission,
         "commission_percent": commission_percent,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utcnow()
     }
-    await db.affiliate_referrals.insert_one(referral_log)
+    try:
+        await db.affiliate_referrals.insert_one(referral_log)
+    except DuplicateKeyError:
+        # A renewal, a concurrent activation or a retry after a failure below.
+        # Referrals logged before ids were derived were credited at the time.
+        referral_log = await db.affiliate_referrals.find_one(
+            {"referred_user_id": buyer_user_id, "course_id": course_id}, {"_id": 0}
+        )
+        if not referral_log or referral_log['id'] != f"{buyer_user_id}:{course_id}":
+            return
+    
+    # Post to the ledger, then update the balance projection. The entry is
+    # unique per referral, so only the caller that posts it applies the $inc
+    commission = referral_log['commission_amount']
+    affiliate_id = referral_log['affiliate_user_id']
+    if await post_affiliate_entry(affiliate_id, "commission", commission, referral_log['id'], earned=commission):
+        await db.users.update_one(
+            {"id": affiliate_id},
+            with_token_bump({
+                "$inc": {
+                    "affiliate_balance": commission,
+                    "total_earned": commission,
+                    "total_referrals": 1
+                }
+            })
+        )
+        evict_user(affiliate_id)
 
 @api_router.post("/affiliate/set-referrer")
 async def set_referrer(affiliate_user_id: str, user: dict = Depends(get_current_user)):
@@ -1501,24 +3347,37 @@ async def set_referrer(affiliate_user_id: str, user: dict = Depends(get_current_
     
     await db.users.update_one(
         {"id": user['id']},
-        {"$set": {"referred_by": affiliate_user_id}}
+        with_token_bump({"$set": {"referred_by": affiliate_user_id}})
     )
+    evict_user(user['id'])
     
     return {"message": "Referrer postavljen"}
 
 # ============= ADMIN AFFILIATE ROUTES =============
 
+# Balances only ever come from earned commission, so total_earned > 0 identifies
+# every affiliate with activity. Queries must include it to use the partial indexes.
+AFFILIATE_ACTIVITY_FILTER = {"total_earned": {"$gt": 0}}
+AFFILIATE_SORTS = {
+    "total_earned": [("total_earned", DESCENDING), ("id", DESCENDING)],
+    "affiliate_balance": [("affiliate_balance", DESCENDING), ("id", DESCENDING)],
+}
+
 @api_router.get("/admin/affiliates")
-async def get_all_affiliates(admin: dict = Depends(get_admin_user)):
-    """Get all users with affiliate stats"""
-    users = await db.users.find(
-        {},
-        {"_id": 0, "password": 0}
-    ).to_list(1000)
-    
-    # Filter users with affiliate activity
-    affiliates = [u for u in users if u.get('total_earned', 0) > 0 or u.get('affiliate_balance', 0) > 0]
-    
+async def get_all_affiliates(
+    response: Response,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    sort: str = Query("total_earned", pattern="^(total_earned|affiliate_balance)$"),
+    admin: dict = Depends(get_admin_user)
+):
+    """Get users with affiliate activity, highest earners first (next page cursor in X-Next-Cursor)"""
+    affiliates, next_cursor = await fetch_page(
+        db.users, dict(AFFILIATE_ACTIVITY_FILTER), AFFILIATE_SORTS[sort], limit, cursor,
+        {"_id": 0, "password": 0, "token_version": 0, "token_changed_at": 0}
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return affiliates
 
 @api_router.put("/admin/affiliate-commission")
@@ -1535,72 +3394,290 @@ async def update_affiliate_commission(data: AffiliateCommissionUpdate, admin: di
     
     return {"message": f"Provizija ažurirana na {data.commission_percent}%"}
 
+PAYOUTS_SORT = [("created_at", DESCENDING), ("id", DESCENDING)]
+# Only the user fields the admin payouts table shows
+PAYOUT_USER_PROJECTION = {"_id": 0, "id": 1, "name": 1, "email": 1, "affiliate_balance": 1}
+
 @api_router.get("/admin/affiliate-payouts")
-async def get_affiliate_payouts(admin: dict = Depends(get_admin_user)):
-    """Get all affiliate payout requests"""
-    payouts = await db.affiliate_payouts.find({}, {"_id": 0}).sort("created_at", -1).to_list(500)
-    
-    # Enrich with user info
-    for payout in payouts:
-        user = await db.users.find_one({"id": payout['user_id']}, {"_id": 0, "password": 0})
-        payout['user'] = user
-    
+async def get_affiliate_payouts(
+    response: Response,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    status: Optional[str] = Query(None, pattern="^(pending|completed|rejected)$"),
+    admin: dict = Depends(get_admin_user)
+):
+    """Get affiliate payout requests with user info, newest first (next page cursor in X-Next-Cursor)"""
+    query: Dict[str, Any] = {}
+    if status:
+        query['status'] = status
+    
+    payouts, next_cursor = await aggregate_page(
+        db.affiliate_payouts, query, PAYOUTS_SORT, limit, cursor,
+        stages=[
+            *lookup_one("users", "user_id", "user", PAYOUT_USER_PROJECTION),
+            {"$project": {"_id": 0}}
+        ]
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return payouts
 
 @api_router.post("/admin/affiliate-payout/{payout_id}/complete")
 async def complete_affiliate_payout(payout_id: str, admin: dict = Depends(get_admin_user)):
     """Mark a payout request as completed"""
-    payout = await db.affiliate_payouts.find_one({"id": payout_id})
-    if not payout:
-        raise HTTPException(status_code=404, detail="Zahtjev za isplatu nije pronađen")
-    
-    if payout['status'] == 'completed':
-        raise HTTPException(status_code=400, detail="Isplata je već označena kao završena")
-    
-    await db.affiliate_payouts.update_one(
-        {"id": payout_id},
+    payout = await db.affiliate_payouts.find_one_and_update(
+        {"id": payout_id, "status": "pending"},
         {"$set": {
             "status": "completed",
-            "completed_at": datetime.now(timezone.utc).isoformat(),
+            "completed_at": utcnow(),
             "completed_by": admin['email']
-        }}
+        }},
+        projection={"_id": 0}
     )
+    if not payout:
+        existing = await db.affiliate_payouts.find_one({"id": payout_id}, {"_id": 0, "status": 1})
+        if not existing:
+            raise HTTPException(status_code=404, detail="Zahtjev za isplatu nije pronađen")
+        if existing['status'] == 'completed':
+            raise HTTPException(status_code=400, detail="Isplata je već označena kao završena")
+        raise HTTPException(status_code=400, detail="Samo pending zahtjevi mogu biti završeni")
+    await post_affiliate_entry(payout['user_id'], "payout_completed", payout['amount'], payout_id)
     
     return {"message": f"Isplata od €{payout['amount']} za {payout['user_email']} označena kao završena"}
 
 @api_router.post("/admin/affiliate-payout/{payout_id}/reject")
 async def reject_affiliate_payout(payout_id: str, admin: dict = Depends(get_admin_user)):
-    """Reject a payout request and return balance to user"""
-    payout = await db.affiliate_payouts.find_one({"id": payout_id})
-    if not payout:
-        raise HTTPException(status_code=404, detail="Zahtjev za isplatu nije pronađen")
-    
-    if payout['status'] != 'pending':
-        raise HTTPException(status_code=400, detail="Samo pending zahtjevi mogu biti odbijeni")
-    
-    # Return balance to user
-    await db.users.update_one(
-        {"id": payout['user_id']},
-        {"$inc": {"affiliate_balance": payout['amount']}}
-    )
-    
-    await db.affiliate_payouts.update_one(
-        {"id": payout_id},
+    """Reject a payout request and return balance to user.
+
+    Rejecting again finishes a refund an earlier attempt left undone.
+    """
+    # refunded_at is null until the balance has been returned
+    payout = await db.affiliate_payouts.find_one_and_update(
+        {"id": payout_id, "status": "pending"},
         {"$set": {
             "status": "rejected",
-            "rejected_at": datetime.now(timezone.utc).isoformat(),
-            "rejected_by": admin['email']
-        }}
+            "rejected_at": utcnow(),
+            "rejected_by": admin['email'],
+            "refunded_at": None
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
+    if not payout:
+        payout = await db.affiliate_payouts.find_one({"id": payout_id}, {"_id": 0})
+        if not payout:
+            raise HTTPException(status_code=404, detail="Zahtjev za isplatu nije pronađen")
+        if payout['status'] != 'rejected' or 'refunded_at' not in payout or payout['refunded_at'] is not None:
+            raise HTTPException(status_code=400, detail="Samo pending zahtjevi mogu biti odbijeni")
+    
+    # Post to the ledger first; only the request that marks the payout
+    # refunded returns the balance
+    await post_affiliate_entry(payout['user_id'], "payout_rejected", payout['amount'], payout_id)
+    refund = await db.affiliate_payouts.update_one(
+        {"id": payout_id, "refunded_at": {"$type": "null"}},
+        {"$set": {"refunded_at": utcnow()}}
+    )
+    if refund.modified_count:
+        await db.users.update_one(
+            {"id": payout['user_id']},
+            with_token_bump({"$inc": {"affiliate_balance": payout['amount']}})
+        )
+        evict_user(payout['user_id'])
     
     return {"message": f"Isplata odbijena. €{payout['amount']} vraćeno na balans korisnika."}
 
+@api_router.get("/admin/affiliate-ledger/verification")
+async def get_affiliate_ledger_verification(run: bool = False, admin: dict = Depends(get_admin_user)):
+    """Latest comparison of affiliate balances with the ledger; `run=true` recomputes it now"""
+    if run or affiliate_ledger_verifier.last_report is None:
+        return await affiliate_ledger_verifier.run()
+    return affiliate_ledger_verifier.last_report
+
+# ============= DATABASE INDEXES =============
+
+# Every index the routes rely on. Unique constraints mirror the places where
+# the code assumes a single match (find_one by id/email/session_id, upserts).
+INDEX_SPECS: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("token_changed_at", ASCENDING)], name="token_changed_at", sparse=True),
+        IndexModel(
+            [("affiliate_code", ASCENDING)], name="affiliate_code_unique", unique=True,
+            partialFilterExpression={"affiliate_code": {"$type": "string"}}
+        ),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel(
+            [("total_earned", DESCENDING), ("id", DESCENDING)], name="affiliate_total_earned",
+            partialFilterExpression={"total_earned": {"$gt": 0}}
+        ),
+        IndexModel(
+            [("affiliate_balance", DESCENDING), ("id", DESCENDING)], name="affiliate_balance",
+            partialFilterExpression={"total_earned": {"$gt": 0}}
+        ),
+    ],
+    "courses": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("order", ASCENDING)], name="order"),
+    ],
+    "lessons": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("course_id", ASCENDING), ("order", ASCENDING)], name="course_id_order"),
+    ],
+    "user_courses": [
+        IndexModel([("user_id", ASCENDING), ("course_id", ASCENDING)], name="user_id_course_id_unique", unique=True),
+        IndexModel([("course_id", ASCENDING)], name="course_id"),
+    ],
+    "user_entitlements": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "subscriptions": [
+        IndexModel([("session_id", ASCENDING)], name="session_id_unique", unique=True),
+        IndexModel(
+            [("stripe_subscription_id", ASCENDING)], name="stripe_subscription_id_unique", unique=True,
+            partialFilterExpression={"stripe_subscription_id": {"$type": "string"}}
+        ),
+        IndexModel([("user_id", ASCENDING), ("course_id", ASCENDING), ("status", ASCENDING)], name="user_id_course_id_status"),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="status_created_at_id"),
+        IndexModel([("course_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)], name="course_id_status_created_at"),
+    ],
+    "payment_transactions": [
+        IndexModel([("session_id", ASCENDING)], name="session_id_unique", unique=True),
+        IndexModel([("payment_status", ASCENDING), ("paid_at", DESCENDING)], name="payment_status_paid_at"),
+    ],
+    "affiliate_referrals": [
+        IndexModel([("referred_user_id", ASCENDING), ("course_id", ASCENDING)], name="referred_user_id_course_id_unique", unique=True),
+        IndexModel([("affiliate_user_id", ASCENDING), ("created_at", DESCENDING)], name="affiliate_user_id_created_at"),
+    ],
+    "affiliate_payouts": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING)], name="user_id_status"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="status_created_at_id"),
+        IndexModel([("user_id", ASCENDING)], name="user_id_pending_unique", unique=True,
+                   partialFilterExpression={"status": "pending"}),
+    ],
+    "affiliate_ledger": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("kind", ASCENDING), ("reference_id", ASCENDING)], name="kind_reference_id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_created_at"),
+        IndexModel([("postings.account", ASCENDING)], name="postings_account"),
+    ],
+    "faqs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("order", ASCENDING)], name="order"),
+    ],
+    "results": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("order", ASCENDING)], name="order"),
+    ],
+    "shop_products": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("order", ASCENDING)], name="order"),
+    ],
+    "settings": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "catalog_versions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "admin_counters": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "analytics_rollups": [
+        IndexModel([("granularity", ASCENDING), ("bucket", ASCENDING)], name="granularity_bucket_unique", unique=True),
+    ],
+    "contact_messages": [
+        IndexModel([("created_at", DESCENDING)], name="created_at_desc"),
+    ],
+    "stripe_events": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("event_created", ASCENDING), ("received_at", ASCENDING)],
+                   name="status_event_created"),
+        IndexModel([("ordering_key", ASCENDING), ("status", ASCENDING), ("event_created", ASCENDING), ("received_at", ASCENDING)],
+                   name="ordering_key_status_event_created"),
+        # Processed events are only kept for redelivery dedupe and auditing
+        IndexModel([("processed_at", ASCENDING)], name="processed_at_ttl", expireAfterSeconds=30 * 24 * 3600),
+    ],
+}
+
+# Failures from the last bootstrap run, keyed by "collection.index_name"
+index_build_errors: Dict[str, str] = {}
+
+async def ensure_indexes():
+    """Create every declared index. Safe to run repeatedly - existing indexes are left alone."""
+    for collection_name, indexes in INDEX_SPECS.items():
+        for index in indexes:
+            name = index.document['name']
+            key = f"{collection_name}.{name}"
+            try:
+                await db[collection_name].create_indexes([index])
+                index_build_errors.pop(key, None)
+            except OperationFailure as e:
+                # Typically duplicates that violate a unique constraint, or an
+                # index with the same keys but different options already exists
+                index_build_errors[key] = str(e)
+                logging.error(f"Index build failed for {key}: {e}")
+    logging.info("Index bootstrap finished")
+
+@api_router.get("/admin/indexes")
+async def get_index_report(admin: dict = Depends(get_admin_user)):
+    """Report declared indexes that are missing and existing indexes that are never used"""
+    report = {}
+    for collection_name, indexes in INDEX_SPECS.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        declared = [index.document['name'] for index in indexes]
+        
+        usage = {}
+        try:
+            async for stat in collection.aggregate([{"$indexStats": {}}]):
+                usage[stat['name']] = stat['accesses']['ops']
+        except OperationFailure as e:
+            logging.warning(f"$indexStats unavailable for {collection_name}: {e}")
+        
+        report[collection_name] = {
+            "missing": [name for name in declared if name not in existing],
+            "undeclared": [name for name in existing if name != "_id_" and name not in declared],
+            "unused": [name for name, ops in usage.items() if name != "_id_" and ops == 0],
+            "usage": usage,
+            "errors": {
+                key.split('.', 1)[1]: error
+                for key, error in index_build_errors.items()
+                if key.split('.', 1)[0] == collection_name
+            }
+        }
+    return report
+
 # ============= ROOT =============
 
 @api_router.get("/")
 async def root():
     return {"message": "Continental Academy API"}
 
+# ============= BACKGROUND JOBS =============
+
+background_tasks: List[asyncio.Task] = []
+
+def start_background_task(coro):
+    background_tasks.append(asyncio.create_task(coro))
+
+async def convert_string_timestamps():
+    """Convert ISO string timestamps left by older releases; a no-op once none remain"""
+    try:
+        await migrate_timestamps(db, report=logging.info)
+    except Exception as e:
+        logging.error(f"Timestamp conversion failed: {e}")
+
+async def run_periodically(interval: float, job: Callable[[], Awaitable[Any]], name: str):
+    """Run `job` every `interval` seconds until cancelled, logging failures"""
+    while True:
+        try:
+            await job()
+        except Exception as e:
+            logging.error(f"{name} failed: {e}")
+        await asyncio.sleep(interval)
+
 # ============= SETUP =============
 
 async def create_admin_user():
@@ -1609,13 +3686,14 @@ async def create_admin_user():
         admin_user = {
             "id": str(uuid.uuid4()),
             "email": "admin@serbiana.com",
-            "password": hash_password("admin123"),
+            "password": await hash_password("admin123"),
             "name": "Administrator",
             "role": "admin",
             "subscription_status": "active",
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": utcnow()
         }
         await db.users.insert_one(admin_user)
+        await bump_admin_counters(total_users=1, active_subscriptions=1)
         logging.info("Admin user created: admin@serbiana.com / admin123")
 
 async def seed_initial_data():
@@ -1633,7 +3711,7 @@ async def seed_initial_data():
                 "price": 29.99,
                 "is_free": False,
                 "order": 1,
-                "created_at": datetime.now(timezone.utc).isoformat()
+                "created_at": utcnow()
             },
             {
                 "id": str(uuid.uuid4()),
@@ -1644,7 +3722,7 @@ async def seed_initial_data():
                 "price": 29.99,
                 "is_free": False,
                 "order": 2,
-                "created_at": datetime.now(timezone.utc).isoformat()
+                "created_at": utcnow()
             },
             {
                 "id": str(uuid.uuid4()),
@@ -1655,10 +3733,11 @@ async def seed_initial_data():
                 "price": 29.99,
                 "is_free": False,
                 "order": 3,
-                "created_at": datetime.now(timezone.utc).isoformat()
+                "created_at": utcnow()
             }
         ]
         await db.courses.insert_many(courses)
+        await bump_admin_counters(total_courses=len(courses))
     
     # Seed Shop Products
     shop_count = await db.shop_products.count_documents({})
@@ -1674,7 +3753,7 @@ async def seed_initial_data():
                 "features": ["1000+ Subscribera", "4000+ Watch Hours", "Monetizacija Aktivna", "Čist Copyright", "Transfer Vlasništva"],
                 "in_stock": True,
                 "order": 1,
-                "created_at": datetime.now(timezone.utc).isoformat()
+                "created_at": utcnow()
             },
             {
                 "id": str(uuid.uuid4()),
@@ -1686,7 +3765,7 @@ async def seed_initial_data():
                 "features": ["10K+ Followera", "Creator Fund Aktivan", "LIVE Gifts Enabled", "Čist Account", "Instant Transfer"],
                 "in_stock": True,
                 "order": 2,
-                "created_at": datetime.now(timezone.utc).isoformat()
+                "created_at": utcnow()
             },
             {
                 "id": str(uuid.uuid4()),
@@ -1698,7 +3777,7 @@ async def seed_initial_data():
                 "features": ["10K+ Followera", "In-Stream Ads Aktivan", "Reels Bonus", "Professional Mode", "Brand Collabs"],
                 "in_stock": True,
                 "order": 3,
-                "created_at": datetime.now(timezone.utc).isoformat()
+                "created_at": utcnow()
             }
         ]
         await db.shop_products.insert_many(shop_products)
@@ -1760,11 +3839,29 @@ async def seed_initial_data():
             ]
         }
         await db.settings.insert_one(default_settings)
+    
+    # Drop anything cached while seeding was still in progress
+    clear_catalog_cache()
 
 @app.on_event("startup")
 async def startup():
+    recaptcha_verifier.start()
+    # Build indexes in the background so a slow build never delays startup
+    start_background_task(ensure_indexes())
+    # Keyset pages compare dates, which never match timestamps older releases stored as strings
+    start_background_task(convert_string_timestamps())
     await create_admin_user()
     await seed_initial_data()
+    catalog_listener.start()
+    if not stripe_webhook_verifier.enabled:
+        logging.warning("STRIPE_WEBHOOK_SECRET is not set; webhook signatures are not verified")
+    stripe_event_consumer.start()
+    start_background_task(run_periodically(
+        ADMIN_COUNTERS_RECONCILE_SECONDS, reconcile_admin_counters, "Admin counters reconciliation"
+    ))
+    start_background_task(run_periodically(
+        AFFILIATE_LEDGER_VERIFY_SECONDS, affiliate_ledger_verifier.run, "Affiliate ledger verification"
+    ))
 
 app.include_router(api_router)
 
@@ -1774,6 +3871,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 logging.basicConfig(
@@ -1784,4 +3882,11 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await catalog_listener.stop()
+    await stripe_event_consumer.stop()
+    await recaptcha_verifier.close()
+    for task in background_tasks:
+        task.cancel()
+    client.close()
+    stripe_gateway.shutdown()
+    password_hasher.shutdown()
\ No newline at end of file
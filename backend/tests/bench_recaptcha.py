@@ -0,0 +1,108 @@
+"""
+Continental Academy - reCAPTCHA verification benchmark
+Compares a new httpx client per registration with the pooled RecaptchaVerifier,
+then checks that the circuit breaker fails fast once the service is down.
+
+Runs against a local siteverify stub, no Google or MongoDB traffic:
+    python tests/bench_recaptcha.py
+"""
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'continental_bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+ITERATIONS = 200
+STUB_SECRET = "stub-secret"
+
+
+class SiteverifyStub(BaseHTTPRequestHandler):
+    """Accepts the token "valid", rejects everything else"""
+
+    protocol_version = "HTTP/1.1"
+    # Buffer each response into one write; headers and body sent separately
+    # wait on delayed ACKs and bury the connection reuse being measured
+    wbufsize = -1
+
+    def do_POST(self):
+        form = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        body = json.dumps({"success": "response=valid" in form}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub() -> ThreadingHTTPServer:
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), SiteverifyStub)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    return stub
+
+
+async def per_request_client(url: str):
+    """The pre-pooling implementation: a new client for every registration"""
+    async with httpx.AsyncClient() as client:
+        response = await client.post(url, data={'secret': STUB_SECRET, 'response': 'valid'})
+        return response.json().get('success')
+
+
+async def measure(name, fn):
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        assert await fn()
+    elapsed_ms = (time.perf_counter() - started) * 1000 / ITERATIONS
+    print(f"{name:<12} avg latency: {elapsed_ms:>6.2f} ms")
+
+
+async def main():
+    stub = start_stub()
+    url = f"http://127.0.0.1:{stub.server_address[1]}/siteverify"
+    verifier = server.RecaptchaVerifier(
+        STUB_SECRET, url, timeout=2, max_concurrency=10, failure_threshold=3, reset_seconds=60
+    )
+    verifier.start()
+    try:
+        await measure("per-request", lambda: per_request_client(url))
+        await measure("pooled", lambda: verifier.verify("valid"))
+        assert await verifier.verify("forged") is False
+
+        # A port nothing listens on stands in for an outage
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        down_port = probe.getsockname()[1]
+        probe.close()
+        down = server.RecaptchaVerifier(
+            STUB_SECRET, f"http://127.0.0.1:{down_port}/siteverify",
+            timeout=2, max_concurrency=10, failure_threshold=3, reset_seconds=60
+        )
+        for _ in range(5):
+            try:
+                await down.verify("valid")
+            except server.RecaptchaUnavailable:
+                pass
+        await down.close()
+        stats = down.stats()
+        assert stats["circuit_open"] and stats["failures"] == 3 and stats["short_circuits"] == 2, stats
+        print(f"breaker      {stats}")
+    finally:
+        await verifier.close()
+        stub.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+"""
+Continental Academy - /api/user/lessons round-trip benchmark
+Compares the legacy per-course lookups with the batched entitlement resolver.
+
+Runs against a local mongod stand-in (a scratch database is created and dropped):
+    MONGO_URL=mongodb://localhost:27017 python tests/bench_user_lessons.py
+"""
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'continental_bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+BENCH_DB_NAME = f"bench_user_lessons_{uuid.uuid4().hex[:8]}"
+SINGLE_COURSES = 6
+BUNDLES = 2
+LESSONS_PER_COURSE = 8
+ITERATIONS = 20
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    """Counts every command sent to the server (find, aggregate, getMore, ...)"""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def legacy_user_lessons(db, user_id):
+    """The pre-batching implementation of get_user_lessons, kept for comparison"""
+    user_courses = await db.user_courses.find({"user_id": user_id}, {"_id": 0}).to_list(100)
+    accessible_course_ids = set()
+    for uc in user_courses:
+        course_id = uc['course_id']
+        accessible_course_ids.add(course_id)
+        course = await db.courses.find_one({"id": course_id}, {"_id": 0})
+        if course and course.get('course_type') == 'bundle':
+            for included_id in course.get('included_courses', []):
+                accessible_course_ids.add(included_id)
+
+    lessons_with_courses = []
+    for course_id in accessible_course_ids:
+        course = await db.courses.find_one({"id": course_id}, {"_id": 0})
+        if course:
+            lessons = await db.lessons.find({"course_id": course_id}, {"_id": 0}).sort("order", 1).to_list(100)
+            if lessons:
+                lessons_with_courses.append({"course": course, "lessons": lessons})
+    return lessons_with_courses
+
+
+async def seed(db):
+    singles = [
+        {"id": str(uuid.uuid4()), "title": f"Course {i}", "course_type": "single", "included_courses": [], "order": i}
+        for i in range(SINGLE_COURSES)
+    ]
+    per_bundle = SINGLE_COURSES // BUNDLES
+    bundles = [
+        {
+            "id": str(uuid.uuid4()),
+            "title": f"Bundle {b}",
+            "course_type": "bundle",
+            "included_courses": [c['id'] for c in singles[b * per_bundle:(b + 1) * per_bundle]],
+            "order": 100 + b
+        }
+        for b in range(BUNDLES)
+    ]
+    await db.courses.insert_many(singles + bundles)
+    await db.lessons.insert_many([
+        {"id": str(uuid.uuid4()), "course_id": c['id'], "title": f"Lesson {n}", "mux_video_id": "bench", "order": n}
+        for c in singles + bundles
+        for n in range(LESSONS_PER_COURSE)
+    ])
+
+    user_id = str(uuid.uuid4())
+    owned = [b['id'] for b in bundles] + [singles[0]['id'], singles[-1]['id']]
+    await db.user_courses.insert_many([{"user_id": user_id, "course_id": course_id} for course_id in owned])
+    return user_id
+
+
+async def measure(name, counter, fn):
+    counter.count = 0
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        result = await fn()
+    elapsed_ms = (time.perf_counter() - started) * 1000 / ITERATIONS
+    round_trips = counter.count / ITERATIONS
+    lessons = sum(len(group['lessons']) for group in result)
+    print(f"{name:<10} round trips/request: {round_trips:>5.1f}   avg latency: {elapsed_ms:>7.2f} ms   "
+          f"courses: {len(result)}   lessons: {lessons}")
+
+
+async def main():
+    counter = RoundTripCounter()
+    bench_client = AsyncIOMotorClient(os.environ['MONGO_URL'], event_listeners=[counter])
+    db = bench_client[BENCH_DB_NAME]
+    server.db = db
+    try:
+        user_id = await seed(db)
+        await measure("legacy", counter, lambda: legacy_user_lessons(db, user_id))
+        await measure("batched", counter, lambda: server.load_user_lesson_groups(user_id))
+    finally:
+        await bench_client.drop_database(BENCH_DB_NAME)
+        bench_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
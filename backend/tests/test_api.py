@@ -5,7 +5,11 @@ Tests for: Auth, Shop, Courses, FAQ, Results, Settings, Admin endpoints
 import pytest
 import requests
 import os
+import json
 import uuid
+import hmac
+import hashlib
+import time
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
 
@@ -15,6 +19,8 @@ ADMIN_PASSWORD = "admin123"
 TEST_USER_EMAIL = f"TEST_user_{uuid.uuid4().hex[:8]}@test.com"
 TEST_USER_PASSWORD = "testpass123"
 TEST_USER_NAME = "Test User"
+# Must match the backend's STRIPE_WEBHOOK_SECRET when signature checks are enabled
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', '')
 
 
 class TestHealthAndSettings:
@@ -43,6 +49,18 @@ class TestHealthAndSettings:
         assert "discord_link" in data
         assert "intro_video_mux_id" in data  # New field for Mux video
         print(f"✓ Settings endpoint passed, hero_title: {data.get('hero_title')}")
+    
+    def test_settings_conditional_get(self):
+        """Test settings returns an ETag and answers If-None-Match with 304"""
+        response = requests.get(f"{BASE_URL}/api/settings")
+        assert response.status_code == 200
+        etag = response.headers.get("ETag")
+        assert etag
+        
+        cached_response = requests.get(f"{BASE_URL}/api/settings", headers={"If-None-Match": etag})
+        assert cached_response.status_code == 304
+        assert cached_response.headers.get("ETag") == etag
+        print(f"✓ Settings conditional GET passed, ETag: {etag}")
 
 
 class TestAuthentication:
@@ -203,6 +221,57 @@ class TestShopCheckout:
         print("✓ Invalid product checkout correctly returns 404")
 
 
+def stripe_signature_headers(payload: str) -> dict:
+    """Stripe-Signature header for `payload`, or none when no secret is configured"""
+    if not STRIPE_WEBHOOK_SECRET:
+        return {}
+    timestamp = str(int(time.time()))
+    signature = hmac.new(
+        STRIPE_WEBHOOK_SECRET.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256
+    ).hexdigest()
+    return {"Stripe-Signature": f"t={timestamp},v1={signature}"}
+
+
+class TestStripeWebhook:
+    """Stripe webhook inbox tests"""
+    
+    def test_webhook_deduplicates_redelivery(self):
+        """Test a redelivered event is acknowledged without being queued twice"""
+        payload = json.dumps({
+            "id": f"evt_test_{uuid.uuid4().hex}",
+            "type": "test.event",
+            "created": 1700000000,
+            "data": {"object": {}}
+        })
+        first = requests.post(f"{BASE_URL}/api/webhook/stripe", data=payload, headers=stripe_signature_headers(payload))
+        assert first.status_code == 200
+        assert first.json()["status"] == "ok"
+        
+        second = requests.post(f"{BASE_URL}/api/webhook/stripe", data=payload, headers=stripe_signature_headers(payload))
+        assert second.status_code == 200
+        assert second.json()["status"] == "duplicate"
+        print("✓ Webhook redelivery deduplicated")
+    
+    def test_webhook_rejects_malformed_payload(self):
+        """Test a body that is not a Stripe event is rejected"""
+        response = requests.post(f"{BASE_URL}/api/webhook/stripe", data="not json", headers=stripe_signature_headers("not json"))
+        assert response.status_code == 400
+        print("✓ Malformed webhook payload rejected")
+    
+    def test_webhook_rejects_bad_signature(self):
+        """Test a forged signature is rejected before the event is stored"""
+        if not STRIPE_WEBHOOK_SECRET:
+            pytest.skip("STRIPE_WEBHOOK_SECRET not configured")
+        payload = json.dumps({"id": f"evt_test_{uuid.uuid4().hex}", "type": "test.event", "data": {"object": {}}})
+        response = requests.post(
+            f"{BASE_URL}/api/webhook/stripe",
+            data=payload,
+            headers={"Stripe-Signature": f"t={int(time.time())},v1={'0' * 64}"}
+        )
+        assert response.status_code == 400
+        print("✓ Forged webhook signature rejected")
+
+
 class TestCoursesEndpoints:
     """Courses CRUD endpoints tests"""
     
@@ -302,6 +371,48 @@ class TestAdminEndpoints:
         assert isinstance(data, list)
         print(f"✓ Admin users list passed, count: {len(data)}")
     
+    def test_admin_users_pagination(self, admin_token):
+        """Test admin users are paged with a keyset cursor and filterable by role"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/users",
+            params={"limit": 1},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        first_page = response.json()
+        assert len(first_page) <= 1
+        
+        next_cursor = response.headers.get("X-Next-Cursor")
+        if next_cursor:
+            second = requests.get(
+                f"{BASE_URL}/api/admin/users",
+                params={"limit": 1, "cursor": next_cursor},
+                headers={"Authorization": f"Bearer {admin_token}"}
+            )
+            assert second.status_code == 200
+            assert all(u["id"] != first_page[0]["id"] for u in second.json())
+        
+        admins = requests.get(
+            f"{BASE_URL}/api/admin/users",
+            params={"role": "admin"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        ).json()
+        assert all(u["role"] == "admin" for u in admins)
+        print(f"✓ Admin users pagination passed, admins: {len(admins)}")
+    
+    def test_admin_users_ndjson_export(self, admin_token):
+        """Test admin users NDJSON export streams one user per line"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/users",
+            params={"format": "ndjson"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = [line for line in response.text.splitlines() if line]
+        assert all("password" not in json.loads(line) for line in lines)
+        print(f"✓ Admin users NDJSON export passed, lines: {len(lines)}")
+    
     def test_admin_messages(self, admin_token):
         """Test admin messages endpoint"""
         response = requests.get(
@@ -313,6 +424,61 @@ class TestAdminEndpoints:
         assert isinstance(data, list)
         print(f"✓ Admin messages passed, count: {len(data)}")
     
+    def test_admin_index_report(self, admin_token):
+        """Test index report lists declared indexes per collection"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/indexes",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert "users" in data
+        for field in ["missing", "undeclared", "unused", "errors"]:
+            assert field in data["users"], f"Missing field: {field}"
+        assert "email_unique" not in data["users"]["missing"]
+        print(f"✓ Admin index report passed, collections: {len(data)}")
+    
+    def test_admin_metrics(self, admin_token):
+        """Test runtime metrics include password hasher queue stats"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/metrics",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert "queue_depth" in data["password_hasher"]
+        assert "in_flight" in data["stripe_gateway"]
+        assert "hit_ratio" in data["user_cache"]
+        print(f"✓ Admin metrics passed, hasher workers: {data['password_hasher']['workers']}")
+    
+    def test_admin_analytics(self, admin_token):
+        """Test analytics returns a zero-filled series for the requested range"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/analytics",
+            params={"granularity": "day", "start": "2024-01-01", "end": "2024-01-07"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert [point["bucket"] for point in data["series"]][0] == "2024-01-01"
+        assert len(data["series"]) == 7
+        assert "revenue" in data["totals"]
+        print(f"✓ Admin analytics passed, revenue: {data['totals']['revenue']}")
+    
+    def test_admin_affiliate_ledger_verification(self, admin_token):
+        """Test the ledger verifier reports drift counts"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/affiliate-ledger/verification",
+            params={"run": "true"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["drift_count"] >= len(data["drift"])
+        assert data["unbalanced_entries"] == 0
+        assert set(data["pending_payouts"]) == {"payouts", "ledger", "drift"}
+        print(f"✓ Affiliate ledger verification passed, affiliates checked: {data['affiliates_checked']}")
+    
     def test_admin_requires_auth(self):
         """Test admin endpoints require authentication"""
         response = requests.get(f"{BASE_URL}/api/admin/stats")
@@ -41,6 +41,7 @@ export default function AdminPage() {
   const [activeTab, setActiveTab] = useState('dashboard');
   const [stats, setStats] = useState(null);
   const [users, setUsers] = useState([]);
+  const [usersCursor, setUsersCursor] = useState(null);
   const [courses, setCourses] = useState([]);
   const [faqs, setFaqs] = useState([]);
   const [results, setResults] = useState([]);
@@ -51,13 +52,16 @@ export default function AdminPage() {
   
   // Subscriptions state
   const [subscriptions, setSubscriptions] = useState([]);
+  const [subscriptionsCursor, setSubscriptionsCursor] = useState(null);
   const [cancelEmail, setCancelEmail] = useState('');
   const [cancelCourseId, setCancelCourseId] = useState('');
   const [cancelling, setCancelling] = useState(false);
   
   // Affiliate state
   const [affiliates, setAffiliates] = useState([]);
+  const [affiliatesCursor, setAffiliatesCursor] = useState(null);
   const [affiliatePayouts, setAffiliatePayouts] = useState([]);
+  const [payoutsCursor, setPayoutsCursor] = useState(null);
   const [newCommissionPercent, setNewCommissionPercent] = useState('');
   
   // Lessons state
@@ -125,6 +129,7 @@ export default function AdminPage() {
       ]);
       setStats(statsRes.data);
       setUsers(usersRes.data);
+      setUsersCursor(usersRes.headers['x-next-cursor'] || null);
       setCourses(coursesRes.data);
       setFaqs(faqsRes.data);
       setResults(resultsRes.data);
@@ -155,9 +160,22 @@ export default function AdminPage() {
     try {
       const res = await axios.get(`${API}/admin/subscriptions`, { headers });
       setSubscriptions(res.data);
+      setSubscriptionsCursor(res.headers['x-next-cursor'] || null);
     } catch (error) {
       console.error('Error fetching subscriptions:', error);
       setSubscriptions([]);
+      setSubscriptionsCursor(null);
+    }
+  };
+
+  const fetchMoreSubscriptions = async () => {
+    if (!subscriptionsCursor) return;
+    try {
+      const res = await axios.get(`${API}/admin/subscriptions`, { headers, params: { cursor: subscriptionsCursor } });
+      setSubscriptions((prev) => [...prev, ...res.data]);
+      setSubscriptionsCursor(res.headers['x-next-cursor'] || null);
+    } catch (error) {
+      toast.error('Greška pri učitavanju pretplata');
     }
   };
 
@@ -205,20 +223,44 @@ export default function AdminPage() {
     try {
       const res = await axios.get(`${API}/admin/affiliates`, { headers });
       setAffiliates(res.data);
+      setAffiliatesCursor(res.headers['x-next-cursor'] || null);
     } catch (error) {
       console.error('Error fetching affiliates:', error);
     }
   };
 
+  const fetchMoreAffiliates = async () => {
+    if (!affiliatesCursor) return;
+    try {
+      const res = await axios.get(`${API}/admin/affiliates`, { headers, params: { cursor: affiliatesCursor } });
+      setAffiliates((prev) => [...prev, ...res.data]);
+      setAffiliatesCursor(res.headers['x-next-cursor'] || null);
+    } catch (error) {
+      toast.error('Greška pri učitavanju affiliates');
+    }
+  };
+
   const fetchAffiliatePayouts = async () => {
     try {
       const res = await axios.get(`${API}/admin/affiliate-payouts`, { headers });
       setAffiliatePayouts(res.data);
+      setPayoutsCursor(res.headers['x-next-cursor'] || null);
     } catch (error) {
       console.error('Error fetching payouts:', error);
     }
   };
 
+  const fetchMoreAffiliatePayouts = async () => {
+    if (!payoutsCursor) return;
+    try {
+      const res = await axios.get(`${API}/admin/affiliate-payouts`, { headers, params: { cursor: payoutsCursor } });
+      setAffiliatePayouts((prev) => [...prev, ...res.data]);
+      setPayoutsCursor(res.headers['x-next-cursor'] || null);
+    } catch (error) {
+      toast.error('Greška pri učitavanju isplata');
+    }
+  };
+
   const updateCommissionPercent = async () => {
     const percent = parseFloat(newCommissionPercent);
     if (isNaN(percent) || percent < 0 || percent > 100) {
@@ -442,6 +484,17 @@ export default function AdminPage() {
   };
 
   // ============= USER HANDLERS =============
+  const fetchMoreUsers = async () => {
+    if (!usersCursor) return;
+    try {
+      const res = await axios.get(`${API}/admin/users`, { headers, params: { cursor: usersCursor } });
+      setUsers((prev) => [...prev, ...res.data]);
+      setUsersCursor(res.headers['x-next-cursor'] || null);
+    } catch (error) {
+      toast.error('Greška pri učitavanju korisnika');
+    }
+  };
+
   const handleToggleSubscription = async (userId, currentStatus) => {
     const newStatus = currentStatus === 'active' ? 'inactive' : 'active';
     try {
@@ -640,6 +693,16 @@ export default function AdminPage() {
                     </tbody>
                   </table>
                 </div>
+                {usersCursor && (
+                  <div className="p-4 border-t border-white/5 text-center">
+                    <button
+                      onClick={fetchMoreUsers}
+                      className="px-4 py-2 rounded-lg bg-white/5 hover:bg-white/10 text-sm"
+                    >
+                      Učitaj još korisnika
+                    </button>
+                  </div>
+                )}
               </div>
 
               {/* Assign Course Panel */}
@@ -797,6 +860,16 @@ export default function AdminPage() {
                       ))}
                     </tbody>
                   </table>
+                  {subscriptionsCursor && (
+                    <div className="pt-4 text-center">
+                      <button
+                        onClick={fetchMoreSubscriptions}
+                        className="px-4 py-2 rounded-lg bg-white/5 hover:bg-white/10 text-sm"
+                      >
+                        Učitaj još pretplata
+                      </button>
+                    </div>
+                  )}
                 </div>
               ) : (
                 <div className="text-center py-12">
@@ -886,6 +959,16 @@ export default function AdminPage() {
                       ))}
                     </tbody>
                   </table>
+                  {affiliatesCursor && (
+                    <div className="pt-4 text-center">
+                      <button
+                        onClick={fetchMoreAffiliates}
+                        className="px-4 py-2 rounded-lg bg-white/5 hover:bg-white/10 text-sm"
+                      >
+                        Učitaj još affiliates
+                      </button>
+                    </div>
+                  )}
                 </div>
               ) : (
                 <div className="text-center py-12">
@@ -967,6 +1050,16 @@ export default function AdminPage() {
                       ))}
                     </tbody>
                   </table>
+                  {payoutsCursor && (
+                    <div className="pt-4 text-center">
+                      <button
+                        onClick={fetchMoreAffiliatePayouts}
+                        className="px-4 py-2 rounded-lg bg-white/5 hover:bg-white/10 text-sm"
+                      >
+                        Učitaj još isplata
+                      </button>
+                    </div>
+                  )}
                 </div>
               ) : (
                 <div className="text-center py-8">
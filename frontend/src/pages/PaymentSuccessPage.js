@@ -14,7 +14,8 @@ export default function PaymentSuccessPage() {
   const { refreshUser } = useAuth();
   const [status, setStatus] = useState('checking'); // checking, success, error
   const [attempts, setAttempts] = useState(0);
-  const maxAttempts = 5;
+  // Each attempt is a long-poll that the server answers as soon as the payment is confirmed
+  const maxAttempts = 3;
 
   useEffect(() => {
     const sessionId = searchParams.get('session_id');
@@ -23,9 +24,15 @@ export default function PaymentSuccessPage() {
       return;
     }
 
-    const checkPaymentStatus = async () => {
+    let cancelled = false;
+
+    const waitForPayment = async () => {
       try {
-        const response = await axios.get(`${API}/payments/status/${sessionId}`);
+        const response = await axios.get(`${API}/payments/status/${sessionId}/wait`, {
+          params: { timeout: 25 },
+          timeout: 35000
+        });
+        if (cancelled) return;
         
         if (response.data.payment_status === 'paid') {
           setStatus('success');
@@ -38,29 +45,31 @@ export default function PaymentSuccessPage() {
           return;
         }
 
-        // Continue polling
+        // Still processing, wait again
         if (attempts < maxAttempts) {
-          setTimeout(() => {
-            setAttempts(prev => prev + 1);
-          }, 2000);
+          setAttempts(prev => prev + 1);
         } else {
           // Max attempts reached, but payment might still be processing
           setStatus('success');
           await refreshUser();
         }
       } catch (error) {
+        if (cancelled) return;
         console.error('Error checking payment status:', error);
         if (attempts >= maxAttempts) {
           setStatus('error');
         } else {
           setTimeout(() => {
-            setAttempts(prev => prev + 1);
+            if (!cancelled) setAttempts(prev => prev + 1);
           }, 2000);
         }
       }
     };
 
-    checkPaymentStatus();
+    waitForPayment();
+    return () => {
+      cancelled = true;
+    };
   }, [attempts, searchParams, navigate, refreshUser]);
 
   return (